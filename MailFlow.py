@@ -1,8 +1,22 @@
-from AppKit import NSAlternateKeyMask, NSApplication, NSBundle, NSMenuItem, \
-        NSLog, NSCommandKeyMask, NSUserDefaults, NSOffState, NSOnState, NSObject
+import tracing
+started = tracing.clock()
+
+# Mail loads the plugin before it has finished launching, so only what is
+# needed to hook in is imported here. AppKit is reached through the classes
+# Mail has already loaded rather than imported, and the text engine is
+# imported by load() the first time a message is flowed, wrapped, encoded
+# or displayed. py2app cannot see those imports, so any module reached only
+# through load() must be listed in the includes of install.py and setup.py.
+
+from Foundation import NSBundle, NSLog, NSNotificationCenter, NSObject, \
+        NSUserDefaults, NSUserDefaultsDidChangeNotification
+from cache import Cache
+from settings import Preferences
 import objc
-import re
-import textwrap
+import sys
+
+NSAlternateKeyMask, NSCommandKeyMask = 1 << 19, 1 << 20
+NSOffState = 0
 
 def Category(classname):
     return objc.Category(objc.lookUpClass(classname))
@@ -10,21 +24,123 @@ def Category(classname):
 def Class(classname):
     return objc.lookUpClass(classname)
 
-def swizzle(classname, selector):
-    def decorator(function):
-        cls = objc.lookUpClass(classname)
-        old = cls.instanceMethodForSelector_(selector)
-        if old.isClassMethod:
-            old = cls.methodForSelector_(selector)
+NSApplication = Class('NSApplication')
+NSMenuItem = Class('NSMenuItem')
+NSRunningApplication = Class('NSRunningApplication')
+
+# The time taken by each stage of startup, and by each deferred import or
+# hook installation when it happens, in order. Each is also recorded as a
+# span, so it appears in the trace report.
+
+startup = []
+
+def stage(name, start):
+    elapsed = tracing.clock() - start
+    startup.append((name, elapsed))
+    tracing.record('startup ' + name, elapsed)
+    return elapsed
+
+def load(name):
+    module = sys.modules.get(name)
+    if module is None:
+        start = tracing.clock()
+        module = __import__(name)
+        stage('import ' + name, start)
+    return module
+
+# Hooks are gathered into groups as the categories are defined, and each
+# group is only swizzled into place by install() once something needs it.
+# Until then Mail runs its own methods untouched.
+
+hooks = []
+
+class Hook(object):
+    # A method replaced by function, which is passed the original as its
+    # second argument. Calls from Mail, the time they take and exceptions
+    # escaping them are counted for report(). These are only the calls
+    # Mail makes into each hook, not every crossing of the PyObjC bridge,
+    # which PyObjC gives no cheap way to count. While disabled, the wrapper
+    # passes straight through to the original before doing anything else.
+    # PyObjC will not put a native method back into a class, so the
+    # wrapper itself stays in place.
+
+    def __init__(self, classname, selector, function, group):
+        self.classname, self.selector, self.group = classname, selector, group
+        self.name = classname + ' ' + selector
+        self.enabled, self.old = True, None
+        self.timing, self.errors = tracing.Timing(), 0
+
+        hook, clock = self, tracing.clock
         def wrapper(self, *args, **kwargs):
-            return function(self, old, *args, **kwargs)
-        new = objc.selector(wrapper, selector = old.selector,
+            old = hook.old
+            if not hook.enabled:
+                return old(self, *args, **kwargs)
+            start = clock()
+            try:
+                return function(self, old, *args, **kwargs)
+            except:
+                hook.errors += 1
+                raise
+            finally:
+                hook.timing.add(clock() - start)
+        self.wrapper = wrapper
+
+    def install(self):
+        cls = objc.lookUpClass(self.classname)
+        old = cls.instanceMethodForSelector_(self.selector)
+        if old.isClassMethod:
+            old = cls.methodForSelector_(self.selector)
+        self.old = old
+        new = objc.selector(self.wrapper, selector = old.selector,
                             signature = old.signature,
                             isClassMethod = old.isClassMethod)
-        objc.classAddMethod(cls, selector, new)
-        return wrapper
+        objc.classAddMethod(cls, self.selector, new)
+
+    def reset(self):
+        self.timing, self.errors = tracing.Timing(), 0
+
+def swizzle(classname, selector, group = 'launch'):
+    def decorator(function):
+        hook = Hook(classname, selector, function, group)
+        hooks.append(hook)
+        return hook.wrapper
     return decorator
 
+def install(group):
+    pending = [hook for hook in hooks
+               if hook.group == group and hook.old is None]
+    if pending:
+        start = tracing.clock()
+        for hook in pending:
+            hook.install()
+        stage('install ' + group, start)
+
+def disable(names):
+    # Turn off each hook named in the DisabledHooks default, either by its
+    # selector alone or by its class and selector separated by a space,
+    # and turn back on any no longer named.
+
+    names = set(names or ())
+    for hook in hooks:
+        hook.enabled = hook.name not in names and hook.selector not in names
+
+def report():
+    # Summarise the calls to each installed hook since it was last reset,
+    # naming it as Objective-C would.
+
+    lines = []
+    for hook in hooks:
+        if hook.old is None:
+            continue
+        timing = hook.timing
+        lines.append('hook %s[%s]: %d calls from Mail, %.3fms total, '
+                     '%.3fms max, %d exceptions%s'
+                     % ('+' if hook.old.isClassMethod else '-', hook.name,
+                        timing.calls, 1000 * timing.total,
+                        1000 * timing.longest, hook.errors,
+                        '' if hook.enabled else ', disabled'))
+    return lines
+
 class DefaultsProxy:
     def __init__(self, typename, delegate):
         self.typename = typename
@@ -63,71 +179,53 @@ class NSUserDefaults(Category('NSUserDefaults')):
     def object(self):
         return DefaultsProxy('object', self)
 
-def flow(text, width, padspace=True):
-    quote, indent = re.match(r'(>+ ?|)(\s*)', text, re.UNICODE).groups()
-    prefix = len(quote)
-    if text[prefix:] == u'-- ':
-        return [text]
-    text = text.rstrip(u' ')
-
-    if not quote:
-        if indent.startswith(u' ') or text.startswith(u'From '):
-            text = u' ' + text
-    if indent or len(text) <= width:
-        return [text]
-
-    matches = re.finditer(r'\S+\s*(?=\S|$)', text[prefix:], re.UNICODE)
-    breaks, lines = [match.end() + prefix for match in matches], []
-    while True:
-        for index, cursor in enumerate(breaks[1:]):
-            if len(text[:cursor].expandtabs()) >= width:
-                cursor = breaks[index]
-                break
-        else:
-            lines.append(text)
-            return lines
-        if padspace:
-            lines.append(text[:cursor] + u' ')
-        else:
-            lines.append(text[:cursor])
-        if not quote and text[cursor:].startswith(u'From '):
-            text, cursor = u' ' + text[cursor:], cursor - 1
-        else:
-            text, cursor = quote + text[cursor:], cursor - prefix
-        breaks = [offset - cursor for offset in breaks[index + 1:]]
-
-def wrap(text, level, width, detect_bullet_list):
-    NSLog('MailFlow to wrap text')
-    initial = subsequent = len(text) - len(text.lstrip())
-    if detect_bullet_list and initial > 0:
-        if text.lstrip().startswith(('- ', '+ ', '* ')):
-            subsequent += 2
-    return textwrap.fill(' '.join(text.split()),
-                         width - level - 1 if level > 0 else width,
-                         break_long_words = False,
-                         break_on_hyphens = False,
-                         initial_indent = ' ' * initial,
-                         subsequent_indent = ' ' * subsequent)
-
 class ComposeViewController(Category('ComposeViewController')):
 
     @classmethod
     def registerWithApplication(cls, app):
         cls.app = app
 
-    @swizzle('ComposeViewController', '_finishLoadingEditor')
+    @swizzle('ComposeViewController', 'loadView')
+    def loadView(self, old):
+        # The first compose window puts the rest of the compose hooks in
+        # place before its editor is loaded.
+
+        install('compose')
+        return old(self)
+
+    @swizzle('ComposeViewController', '_finishLoadingEditor', 'compose')
     def _finishLoadingEditor(self, old):
         result = old(self)
-        if self.messageType() not in [1, 2, 3, 8]:
-            return result
+        if self.messageType() in [1, 2, 3, 8]:
+            self.prepareEditor()
+        return result
+
+    @tracing.traced('prepareEditor')
+    def prepareEditor(self):
+        # Tidy the linefeeds in every blockquote and, when forwarding,
+        # separate each outermost blockquote from what precedes it, all in
+        # one pass over the blockquotes in document order. The depth of
+        # each is found from a stack of the blockquotes containing it.
 
         view = self.composeWebView()
         document = view.mainFrame().DOMDocument()
         view.contentElement().removeStrayLinefeeds()
         blockquotes = document.getElementsByTagName_('BLOCKQUOTE')
-        for index in xrange(blockquotes.length()):
-            if blockquotes.item_(index):
-                blockquotes.item_(index).removeStrayLinefeeds()
+        count, enclosing = blockquotes.length(), []
+        separate = self.messageType() == 3
+        for index in xrange(count):
+            blockquote = blockquotes.item_(index)
+            if not blockquote:
+                continue
+            blockquote.removeStrayLinefeeds()
+            if separate:
+                while enclosing and not enclosing[-1].contains_(blockquote):
+                    enclosing.pop()
+                if not enclosing:
+                    blockquote.parentNode().insertBefore__(
+                        document.createElement_('BR'), blockquote)
+                enclosing.append(blockquote)
+        tracing.count('editor blockquotes', count)
 
         if self.messageType() in [1, 2, 8]:
             if self.app.is_fix_attribution:
@@ -158,20 +256,12 @@ class ComposeViewController(Category('ComposeViewController')):
                 view.moveToEndOfDocument_(None)
                 view.insertParagraphSeparator_(None)
 
-        if self.messageType() == 3:
-            for index in xrange(blockquotes.length()):
-                blockquote = blockquotes.item_(index)
-                if blockquote.quoteLevel() == 1:
-                    blockquote.parentNode().insertBefore__(
-                        document.createElement_('BR'), blockquote)
-
         view.insertParagraphSeparator_(None)
         view.undoManager().removeAllActions()
         self.setHasUserMadeChanges_(False)
         self.backEnd().setHasChanges_(False)
-        return result
 
-    @swizzle('ComposeViewController', 'show')
+    @swizzle('ComposeViewController', 'show', 'compose')
     def show(self, old):
         result = old(self)
         if self.messageType() in [1, 2, 8]:
@@ -194,12 +284,73 @@ class EditingMessageWebView(Category('EditingMessageWebView')):
     def registerWithApplication(cls, app):
         cls.app = app
 
-    @swizzle('EditingMessageWebView', 'decreaseIndentation:')
-    def decreaseIndentation_(self, original, sender, indent = 2):
+    @swizzle('EditingMessageWebView', 'decreaseIndentation:', 'compose')
+    def decreaseIndentation_(self, original, sender):
         if self.contentElement().className() != 'ApplePlainTextBody':
             return original(self, sender)
 
         self.undoManager().beginUndoGrouping()
+        if not self.reindentSelection(self.app.indent_width, True):
+            self.outdentParagraphs(self.app.indent_width)
+        self.undoManager().endUndoGrouping()
+
+    @swizzle('EditingMessageWebView', 'increaseIndentation:', 'compose')
+    def increaseIndentation_(self, original, sender):
+        if self.contentElement().className() != 'ApplePlainTextBody':
+            return original(self, sender)
+
+        self.undoManager().beginUndoGrouping()
+        if not self.reindentSelection(self.app.indent_width):
+            self.indentParagraphs(self.app.indent_width)
+        self.undoManager().endUndoGrouping()
+
+    def reindentSelection(self, indent, outdent = False):
+        # Read the body once, reindent every line touching the selection in
+        # Python and write the result back as one replacement for each run
+        # of lines at the same quote level. The selection is then restored,
+        # moved along with the text around it. If either end of the
+        # selection is not within text, do nothing and return False.
+
+        compose = load('compose')
+        body = compose.Snapshot(self.contentElement())
+        affinity = self.selectionAffinity()
+        selection = self.selectedDOMRange()
+        start = body.locate(selection.startContainer(),
+                            selection.startOffset())
+        end = body.locate(selection.endContainer(), selection.endOffset())
+        if start is None or end is None:
+            return False
+
+        # A selection ending at the very start of a line does not include
+        # that line, as with the paragraph-by-paragraph version.
+
+        stop = end[0] if end[1] == 0 and end[0] > start[0] else end[0] + 1
+        edits, shifts = compose.indentation(body.lines, start[0], stop, indent,
+                                    outdent)
+        if not edits:
+            return True
+
+        document = self.mainFrame().DOMDocument()
+        for first, last, text in reversed(edits):
+            target = document.createRange()
+            target.setStart__(*body.lines[first].start)
+            target.setEnd__(*body.lines[last - 1].end)
+            self.setSelectedDOMRange_affinity_(target, affinity)
+            self.insertTextWithoutReplacement_(text)
+
+        body = compose.Snapshot(self.contentElement())
+        start = body.position(start[0],
+                              max(0, start[1] + shifts.get(start[0], 0)))
+        end = body.position(end[0], max(0, end[1] + shifts.get(end[0], 0)))
+        if start is not None and end is not None:
+            target = document.createRange()
+            target.setStart__(*start)
+            target.setEnd__(*end)
+            self.setSelectedDOMRange_affinity_(target, affinity)
+        return True
+
+    def outdentParagraphs(self, indent):
+        import re
         affinity = self.selectionAffinity()
         selection = self.selectedDOMRange()
 
@@ -224,14 +375,8 @@ class EditingMessageWebView(Category('EditingMessageWebView')):
                 self.moveForward_(None)
 
         self.setSelectedDOMRange_affinity_(selection, affinity)
-        self.undoManager().endUndoGrouping()
-
-    @swizzle('EditingMessageWebView', 'increaseIndentation:')
-    def increaseIndentation_(self, original, sender, indent = 2):
-        if self.contentElement().className() != 'ApplePlainTextBody':
-            return original(self, sender)
 
-        self.undoManager().beginUndoGrouping()
+    def indentParagraphs(self, indent):
         affinity = self.selectionAffinity()
         selection = self.selectedDOMRange()
 
@@ -254,14 +399,11 @@ class EditingMessageWebView(Category('EditingMessageWebView')):
                 self.moveForward_(None)
             self.setSelectedDOMRange_affinity_(selection, affinity)
 
-        self.undoManager().endUndoGrouping()
-
+    @tracing.traced('wrapParagraph')
     def wrapParagraph(self):
         # Note the quote level of the current paragraph and the location of
         # the end of the message to avoid attempts to move beyond it.
 
-        NSLog('MailFlow wrap paragraph')
-
         self.moveToEndOfDocumentAndModifySelection_(None)
         last = self.selectedRange().location + self.selectedRange().length
 
@@ -279,18 +421,15 @@ class EditingMessageWebView(Category('EditingMessageWebView')):
                 location = self.selectedRange().location
                 if location + self.selectedRange().length >= last:
                     self.moveToEndOfParagraph_(None)
-                    NSLog('MailFlow wrap paragraph done 1')
                     return
                 if self.selectedText().strip():
                     self.moveToBeginningOfParagraph_(None)
-                    NSLog('MailFlow wrap paragraph done 2')
                     return
 
         # Otherwise move to the start of this paragraph block, working
         # upward until we hit the start of the message, a blank line or a
         # change in quote level.
 
-        NSLog('MailFlow paragraph start')
         while self.selectedRange().location > 0:
             self.moveUp_(None)
             if self.quoteLevelAtStartOfSelection() != level:
@@ -346,14 +485,17 @@ class EditingMessageWebView(Category('EditingMessageWebView')):
             selection.setEnd__(self.selectedDOMRange().endContainer(),
                                self.selectedDOMRange().endOffset())
         self.setSelectedDOMRange_affinity_(selection, affinity)
-        NSLog('MailFlow scanned paragraph: wrap width=%d, detect_bullet_list=%s' % (self.app.wrap_width, self.app.detect_bullet_list))
-
         # Re-fill the text allowing for quote level and retaining block
         # indentation, then insert it to replace the selection.
 
-        NSLog('MailFlow before wrap')
-        text = wrap(self.selectedText().expandtabs(), level, self.app.wrap_width, self.app.detect_bullet_list) + '\n'
-        NSLog('MailFlow done wrap')
+        settings = self.app.settings
+        cache = self.app.cache if settings.flow_cache > 0 else None
+        with tracing.span('wrap'):
+            text = load('flowtext').wrap(self.selectedText().expandtabs(),
+                                         level,
+                        settings.wrap_width, settings.detect_bullet_list,
+                        settings.is_optimal_wrap, cache) + '\n'
+        tracing.count('wrap lines', text.count('\n'))
         self.insertTextWithoutReplacement_(text)
 
         # Reduce the quote level of the trailing blank line if necessary,
@@ -401,6 +543,13 @@ class EditingMessageWebView(Category('EditingMessageWebView')):
         # Combine the operation into a single undo group for UI purposes.
 
         self.undoManager().beginUndoGrouping()
+        if self.app.is_snapshot_wrap:
+            self.wrapSnapshot()
+        else:
+            self.wrapCaret()
+        self.undoManager().endUndoGrouping()
+
+    def wrapCaret(self):
         if self.selectedRange().length == 0:
             # self.selectAll_(None)
             self.wrapParagraph()
@@ -416,7 +565,62 @@ class EditingMessageWebView(Category('EditingMessageWebView')):
             self.moveBackward_(None)
         else:
             self.deleteBackward_(None)
-        self.undoManager().endUndoGrouping()
+
+    @tracing.traced('wrapSnapshot')
+    def wrapSnapshot(self):
+        # Read the lines and quote levels of the whole body in one walk of
+        # the DOM and refill the paragraph blocks touching the selection in
+        # Python. Only lines which differ from the refilled text are
+        # replaced, working from the bottom up so the recorded positions
+        # of those above are not disturbed. An already wrapped message is
+        # left untouched, though the caret still moves on.
+
+        compose = load('compose')
+        with tracing.span('snapshot'):
+            lines = compose.snapshot(self.contentElement())
+        selection = self.selectedDOMRange()
+        def compare(position):
+            return selection.comparePoint_offset_(*position)
+        paragraphs = list(compose.paragraphs(lines))
+        blocks = compose.overlapping(lines, paragraphs, compare)
+        following = compose.following(lines, paragraphs, compare)
+
+        edits, settings = [], self.app.settings
+        cache = self.app.cache if settings.flow_cache > 0 else None
+        for block in blocks:
+            with tracing.span('wrap'):
+                text = compose.refill(lines, block, settings.wrap_width,
+                                      settings.detect_bullet_list,
+                                      settings.is_optimal_wrap, cache)
+            edits.extend(compose.changes(lines, block, text))
+        tracing.count('wrap lines', len(lines))
+        tracing.count('wrap edits', len(edits))
+
+        document = self.mainFrame().DOMDocument()
+        affinity = self.selectionAffinity()
+        for start, stop, text in reversed(edits):
+            target = document.createRange()
+            target.setStart__(*lines[start].start)
+            target.setEnd__(*lines[stop - 1].end)
+            self.setSelectedDOMRange_affinity_(target, affinity)
+            self.insertTextWithoutReplacement_(text)
+
+        # Leave the caret at the start of the next paragraph block, or the
+        # end of the message if there is none, so that Wrap Once steps
+        # through the message a block at a time when repeated.
+
+        if following < len(paragraphs):
+            line = paragraphs[following].start + sum(
+                text.count(u'\n') + 1 - (stop - start)
+                for start, stop, text in edits)
+            if edits:
+                lines = compose.snapshot(self.contentElement())
+            target = document.createRange()
+            target.setStart__(*lines[line].start)
+            target.setEnd__(*lines[line].start)
+            self.setSelectedDOMRange_affinity_(target, affinity)
+        else:
+            self.moveToEndOfDocument_(None)
 
     def insertTextWithoutReplacement_(self, text):
         if self.isAutomaticTextReplacementEnabled():
@@ -433,7 +637,7 @@ class EditingMessageWebView(Category('EditingMessageWebView')):
         return self.selectedDOMRange().stringValue() or ''
 
 class MCMessage(Category('MCMessage')):
-    @swizzle('MCMessage', 'forwardedMessagePrefixWithSpacer:')
+    @swizzle('MCMessage', 'forwardedMessagePrefixWithSpacer:', 'compose')
     def forwardedMessagePrefixWithSpacer_(self, old, *args):
         return u''
 
@@ -443,48 +647,103 @@ class MCMessageGenerator(Category('MCMessageGenerator')):
     def registerWithApplication(cls, app):
         cls.app = app
 
-    @swizzle('MCMessageGenerator', '_encodeDataForMimePart:withPartData:')
+    @swizzle('MCMessageGenerator', '_encodeDataForMimePart:withPartData:',
+             'compose')
+    @tracing.traced('encode')
     def _encodeDataForMimePart_withPartData_(self, old, part, data):
         if part.type() != 'text' or part.subtype() != 'plain':
             return old(self, part, data)
 
-        text = bytes(data.objectForKey_(part))
-        if any(len(line) > 998 for line in text.splitlines()):
-            return old(self, part, data)
-
-        try:
-            text.decode('ascii')
-            part.setContentTransferEncoding_('7bit')
-        except UnicodeDecodeError:
-            part.setContentTransferEncoding_('8bit')
+        mimescan = load('mimescan')
+        body = data.objectForKey_(part)
+        stats = mimescan.scan(body)
+        tracing.count('encode bytes', stats.size)
+        transfer = mimescan.encoding(stats)
+
+        # With a line too long for SMTP, Mail would quoted-printable the
+        # whole part, so encode it here as quoted-printable or base64,
+        # whichever comes out smaller.
+
+        if transfer is None:
+            choice = mimescan.cheapest(body, stats)
+            body.setData_(buffer(choice.encoded))
+            tracing.count('encode bytes saved', choice.saved)
+            transfer = choice.transfer
+        part.setContentTransferEncoding_(transfer)
         return True
 
     @swizzle('MCMessageGenerator',
-             '_newPlainTextPartWithAttributedString:partData:')
+             '_newPlainTextPartWithAttributedString:partData:', 'compose')
 
     def _newPlainTextPartWithAttributedString_partData_(self, old, *args):
-        if not self.app.should_wrap:
+        settings = self.app.settings
+        if not settings.should_wrap:
             return old(self, *args)
         event = NSApplication.sharedApplication().currentEvent()
         result = old(self, *args)
         if event and event.modifierFlags() & NSAlternateKeyMask:
             return result
 
+        # UTF-8 and ASCII bodies are flowed in place from a view of the
+        # part data. Any other charset is decoded and flowed as text. Lines
+        # already flowed in the background while composing are taken from
+        # the cache, and only those changed since are flowed here.
+
+        flowtext = load('flowtext')
         charset = result.bodyParameterForKey_('charset') or 'utf-8'
         data = args[1].objectForKey_(result)
-        lines = bytes(data).decode(charset).split('\n')
-        lines = [line for text in lines for line in flow(text, self.app.wrap_width + 1)]
-        data.setData_(buffer(u'\n'.join(lines).encode(charset)))
+        width = settings.wrap_width + 1
+        cache = self.app.cache if settings.flow_cache > 0 else None
+        if tracing.active:
+            tracing.count('flow bytes in', data.length())
+        with tracing.span('flow'):
+            if charset.lower() in ('utf-8', 'utf8', 'us-ascii', 'ascii'):
+                flowed = flowtext.flow_bytes(data, width, cache=cache)
+            else:
+                lines = bytes(data).decode(charset).split('\n')
+                lines = [line for text in lines
+                         for line in flowtext.flow(text, width, cache=cache)]
+                flowed = u'\n'.join(lines).encode(charset)
+            data.setData_(buffer(flowed))
+        if tracing.active:
+            tracing.count('flow bytes out', len(flowed))
+            tracing.count('flow lines', flowed.count(b'\n') + 1)
 
         result.setBodyParameter_forKey_('yes', 'delsp')
-        if self.app.is_flow_text:
+        if settings.is_flow_text:
             result.setBodyParameter_forKey_('flowed', 'format')
         return result
 
 
+def decoded(part):
+    # Return the text of a text/plain part, or None to leave the part to
+    # Mail if it is some other type or its charset is not understood.
+
+    if part.type() != 'text' or part.subtype() != 'plain':
+        return None
+    charset = part.bodyParameterForKey_('charset') or 'us-ascii'
+    try:
+        return bytes(part.bodyData()).decode(charset)
+    except (LookupError, UnicodeDecodeError):
+        return None
+
 class MCMimePart(Category('MCMimePart')):
+
+    @classmethod
+    def registerWithApplication(cls, app):
+        cls.app = app
+
     @swizzle('MCMimePart', '_decodeText')
+    @tracing.traced('decodeText')
     def _decodeText(self, old):
+        if self.app.settings.is_render_text:
+            text = decoded(self)
+            if text is not None:
+                flowed = self.bodyParameterForKey_('format') or ''
+                delsp = self.bodyParameterForKey_('delsp') or ''
+                return load('render').render(text,
+                                             flowed.lower() == 'flowed',
+                                             delsp.lower() == 'yes')
         result = old(self)
         if result.startswith(u' '):
             result = u'&nbsp;' + result[1:]
@@ -496,7 +755,7 @@ class MessageViewController(Category('MessageViewController')):
     def registerWithApplication(cls, app):
         cls.app = app
 
-    @swizzle('MessageViewController', 'forward:')
+    @swizzle('MessageViewController', 'forward:', 'forward')
     def forward_(self, old, *args):
         if not self.app.should_wrap:
             return old(self, *args)
@@ -511,7 +770,7 @@ class MessageViewer(Category('MessageViewer')):
     def registerWithApplication(cls, app):
         cls.app = app
 
-    @swizzle('MessageViewer', 'forwardMessage:')
+    @swizzle('MessageViewer', 'forwardMessage:', 'forward')
     def forwardMessage_(self, old, *args):
         if not self.app.should_wrap:
             return old(self, *args)
@@ -525,7 +784,7 @@ class SingleMessageViewer(Category('SingleMessageViewer')):
     def registerWithApplication(cls, app):
         cls.app = app
 
-    @swizzle('SingleMessageViewer', 'forwardMessage:')
+    @swizzle('SingleMessageViewer', 'forwardMessage:', 'forward')
     def forwardMessage_(self, old, *args):
         if not self.app.should_wrap:
             return old(self, *args)
@@ -538,68 +797,238 @@ class App(object):
     def __init__(self, version):
         self.version = version
         self.prefs = NSUserDefaults.standardUserDefaults()
-        self.prefs.registerDefaults_(dict(
-            FlowText = False,
-            WrapText = False,
-            WrapOnce = False,
-            FixAttribution = False,
-            BulletLists = True,
-            IndentWidth = 2,
-            WrapWidth = 76,
-        ))
+        self.preferences = Preferences(self.prefs)
+        self.preferences.register()
+        self.environment_trace = tracing.active
+        self.default_trace = self.settings.is_tracing
+        tracing.enable(self.environment_trace or self.default_trace)
+        self.cache = Cache(self.settings.flow_cache << 10)
+        self.background = None
+        self.observer = DefaultsObserver.alloc().initWithApp_(self)
+        self.composer = ComposeObserver.alloc().initWithApp_(self)
+        self.menu = None
+        self.forwarding()
+        disable(self.settings.disabled_hooks)
+
+    def forwarding(self):
+        # MIME forward only applies while wrapping or flowing, so its hooks
+        # are not installed until one of them is turned on. Once in place,
+        # they check the setting for themselves.
+
+        if self.settings.should_wrap:
+            install('forward')
+
+    def launched(self):
+        # Called once Mail has finished launching, to extend its menus.
+        start = tracing.clock()
         self.menu = MailFlowMenu.alloc().initWithApp_(self).inject()
+        stage('menu', start)
+        NSLog('MailFlow startup: %@', ', '.join('%s %.1fms'
+              % (name, 1000 * elapsed) for name, elapsed in startup))
+
+    @property
+    def preflow(self):
+        # The background flowing thread is started on first use.
+        if self.background is None:
+            self.background = load('preflow').Preflow(self.cache)
+        return self.background
+
+    def reload(self):
+        # Called whenever the defaults change. Turning off the Trace
+        # default logs a report of everything traced since it was on, even
+        # if MAILFLOW_TRACE keeps tracing going.
+
+        self.preferences.invalidate()
+        self.cache.resize(self.settings.flow_cache << 10)
+        self.forwarding()
+        disable(self.settings.disabled_hooks)
+        if self.default_trace and not self.settings.is_tracing:
+            self.dump()
+        self.default_trace = self.settings.is_tracing
+        tracing.enable(self.environment_trace or self.default_trace)
+
+    def terminate(self):
+        # Called as Mail quits, to log whatever is still being traced.
+        if tracing.active:
+            self.dump()
+
+    def dump(self):
+        for line in tracing.report() + report():
+            NSLog('MailFlow trace: %@', line)
+        tracing.reset()
+        for hook in hooks:
+            hook.reset()
+
+    # Take one snapshot of the settings per operation. The properties
+    # below each read the current snapshot, which is only re-read from
+    # NSUserDefaults after a change.
+
+    @property
+    def settings(self):
+        return self.preferences.snapshot()
 
     @property
     def should_wrap(self):
-        return self.is_flow_text or self.is_wrap_text
+        return self.settings.should_wrap
 
     @property
     def is_flow_text(self):
-        return self.prefs.bool["FlowText"]
+        return self.settings.is_flow_text
 
     @is_flow_text.setter
     def is_flow_text(self, value):
-        self.prefs.bool["FlowText"] = value
+        self.preferences.update('is_flow_text', value)
 
     @property
     def is_wrap_text(self):
-        return self.prefs.bool["WrapText"]
+        return self.settings.is_wrap_text
 
     @is_wrap_text.setter
     def is_wrap_text(self, value):
-        self.prefs.bool["WrapText"] = value
+        self.preferences.update('is_wrap_text', value)
 
     @property
     def is_fix_attribution(self):
-        return self.prefs.bool["FixAttribution"]
+        return self.settings.is_fix_attribution
 
     @is_fix_attribution.setter
     def is_fix_attribution(self, value):
-        self.prefs.bool["FixAttribution"] = value
+        self.preferences.update('is_fix_attribution', value)
 
     @property
     def detect_bullet_list(self):
-        return self.prefs.bool["BulletLists"]
+        return self.settings.detect_bullet_list
 
     @detect_bullet_list.setter
     def detect_bullet_list(self, value):
-        self.prefs.bool["BulletLists"] = value
+        self.preferences.update('detect_bullet_list', value)
 
     @property
     def indent_width(self):
-        return self.prefs.int["IndentWidth"]
+        return self.settings.indent_width
 
     @indent_width.setter
     def indent_width(self, value):
-        self.prefs.int["IndentWidth"] = value
+        self.preferences.update('indent_width', value)
 
     @property
     def wrap_width(self):
-        return self.prefs.int["WrapWidth"]
+        return self.settings.wrap_width
 
     @wrap_width.setter
     def wrap_width(self, value):
-        self.prefs.int["WrapWidth"] = value
+        self.preferences.update('wrap_width', value)
+
+    @property
+    def is_optimal_wrap(self):
+        return self.settings.is_optimal_wrap
+
+    @is_optimal_wrap.setter
+    def is_optimal_wrap(self, value):
+        self.preferences.update('is_optimal_wrap', value)
+
+    @property
+    def is_snapshot_wrap(self):
+        return self.settings.is_snapshot_wrap
+
+    @is_snapshot_wrap.setter
+    def is_snapshot_wrap(self, value):
+        self.preferences.update('is_snapshot_wrap', value)
+
+class LaunchObserver(NSObject):
+    # Wait until Mail has finished launching before adding to its menus,
+    # so the plugin does not hold up the launch itself.
+
+    def initWithApp_(self, app):
+        self = objc.super(LaunchObserver, self).init()
+        if self is None:
+            return None
+        self.app = app
+        if NSRunningApplication.currentApplication().isFinishedLaunching():
+            app.launched()
+        else:
+            NSNotificationCenter.defaultCenter() \
+                .addObserver_selector_name_object_(self,
+                    'applicationDidFinishLaunching:',
+                    'NSApplicationDidFinishLaunchingNotification', None)
+        return self
+
+    def applicationDidFinishLaunching_(self, notification):
+        NSNotificationCenter.defaultCenter().removeObserver_(self)
+        self.app.launched()
+
+class DefaultsObserver(NSObject):
+    def initWithApp_(self, app):
+        self = objc.super(DefaultsObserver, self).init()
+        if self is None:
+            return None
+        self.app = app
+        center = NSNotificationCenter.defaultCenter()
+        center.addObserver_selector_name_object_(self, 'defaultsDidChange:',
+            NSUserDefaultsDidChangeNotification, None)
+        center.addObserver_selector_name_object_(self,
+            'applicationWillTerminate:',
+            'NSApplicationWillTerminateNotification', None)
+        return self
+
+    def defaultsDidChange_(self, notification):
+        self.app.reload()
+
+    def applicationWillTerminate_(self, notification):
+        self.app.terminate()
+
+class ComposeObserver(NSObject):
+    # Pre-flow the message being composed once the user has stopped typing
+    # for PreflowDelay milliseconds. Every change cancels the pending
+    # request and schedules another, so the body is only read from the DOM
+    # when the user pauses. The whole body is read at the first pause in a
+    # compose view, and after that only the block being typed in, as the
+    # rest is already in the flow cache.
+
+    def initWithApp_(self, app):
+        self = objc.super(ComposeObserver, self).init()
+        if self is None:
+            return None
+        self.app, self.view = app, None
+        NSNotificationCenter.defaultCenter() \
+            .addObserver_selector_name_object_(self, 'webViewDidChange:',
+                'WebViewDidChangeNotification', None)
+        return self
+
+    def webViewDidChange_(self, notification):
+        view = notification.object()
+        NSObject.cancelPreviousPerformRequestsWithTarget_selector_object_(
+            self, 'preflow:', view)
+        settings = self.app.settings
+        if settings.preflow_delay > 0 and settings.flow_cache > 0 \
+                and settings.should_wrap:
+            self.performSelector_withObject_afterDelay_(
+                'preflow:', view, settings.preflow_delay / 1000.0)
+
+    @tracing.traced('preflowSnapshot')
+    def preflow_(self, view):
+        if not view.isKindOfClass_(Class('EditingMessageWebView')):
+            return
+        content = view.contentElement()
+        if not content or content.className() != 'ApplePlainTextBody':
+            return
+
+        # Views are remembered by hash rather than retained. Should a new
+        # view reuse the hash of a closed one, or the caret not be within
+        # a block, anything not read is flowed when sending as before.
+
+        compose, whole = load('compose'), view.hash() != self.view
+        if whole:
+            lines, self.view = compose.snapshot(content), view.hash()
+        else:
+            selection = view.selectedDOMRange()
+            block = selection and compose.enclosing(content,
+                                                    selection.startContainer())
+            if not block:
+                return
+            lines = compose.snapshot(*block)
+        self.app.preflow.submit(compose.plain(lines),
+                                self.app.settings.wrap_width + 1, whole)
 
 class MailFlowMenu(NSObject):
     def initWithApp_(self, app):
@@ -648,6 +1077,8 @@ class MailFlowMenu(NSObject):
 class MailFlow(Class('MVMailBundle')):
     @classmethod
     def initialize(self):
+        stage('import', started)
+        start = tracing.clock()
         self.registerBundle()
 
         bundle = NSBundle.bundleWithIdentifier_('uk.me.cdw.MailFlow')
@@ -656,10 +1087,14 @@ class MailFlow(Class('MVMailBundle')):
         app = App(version)
 
         MCMessageGenerator.registerWithApplication(app)
+        MCMimePart.registerWithApplication(app)
         MessageViewController.registerWithApplication(app)
         MessageViewer.registerWithApplication(app)
         SingleMessageViewer.registerWithApplication(app)
         EditingMessageWebView.registerWithApplication(app)
         ComposeViewController.registerWithApplication(app)
+        install('launch')
+        stage('initialise', start)
 
+        app.launcher = LaunchObserver.alloc().initWithApp_(app)
         NSLog('Loaded MailFlow')
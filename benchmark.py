@@ -0,0 +1,292 @@
+#!/usr/bin/python
+
+from flowtext import flow, flow_bytes, wrap
+from mimescan import cheapest, encoding, scan
+from render import render
+import getopt
+import json
+import os
+import pbmbox
+import platform
+import random
+import sys
+import textwrap
+import tracing
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Benchmarks of the MailFlow text paths which run headless, on a corpus
+# generated to mix every kind of line the plugin has to handle. Results
+# are compared with a baseline stored in benchmark.json alongside this
+# script, and any benchmark running slower than the baseline by more than
+# the threshold is reported as a regression. The baseline records the
+# machine and interpreter it was measured on, and is only compared with
+# results from the same.
+#
+# Shared machines slow down by half or more for tens of seconds at a time.
+# Alongside each size, a reference workload using only the standard library
+# is timed in the same rounds, and results are scaled by how much faster or
+# slower it ran than when the baseline was recorded before being compared.
+
+baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'benchmark.json')
+units = {'K': 1 << 10, 'M': 1 << 20}
+sizes = ['1K', '64K', '1M', '16M', '50M']
+devnull = pbmbox.sink(os.devnull)
+width = 76
+
+vocabulary = (u'the quick brown fox jumps over a lazy dog while mail '
+              u'clients reflow paragraphs to suit narrow displays and '
+              u'caf\xe9 na\xefve r\xe9sum\xe9 stra\xdfe').split()
+ideographs = [u'\u65e5\u672c\u8a9e', u'\u6587\u5b57', u'\u6f22\u5b57',
+              u'\u30c6\u30ad\u30b9\u30c8', u'\u3072\u3089\u304c\u306a']
+
+def sentence(rng, low, high):
+    return u' '.join(rng.choice(vocabulary)
+                     for _ in range(rng.randint(low, high)))
+
+kinds = [
+    lambda rng: sentence(rng, 20, 150),
+    lambda rng: sentence(rng, 20, 150),
+    lambda rng: sentence(rng, 3, 10),
+    lambda rng: u'See https://example.com/%s for details.'
+                % u''.join(rng.choice(u'abcdefxyz0123/') for _ in range(120)),
+    lambda rng: u'>' * rng.randint(1, 6) + u' ' + sentence(rng, 10, 80),
+    lambda rng: u'>>>>' + sentence(rng, 5, 40),
+    lambda rng: u'\t' + u'\t'.join(rng.choice(vocabulary)
+                                   for _ in range(rng.randint(2, 8))),
+    lambda rng: u'  %s %s' % (rng.choice(u'-+*'), sentence(rng, 10, 40)),
+    lambda rng: u'\u3000'.join(rng.choice(ideographs)
+                               for _ in range(rng.randint(10, 60))),
+    lambda rng: u'From ' + sentence(rng, 5, 30),
+    lambda rng: u'-- ',
+    lambda rng: u'',
+    lambda rng: u'',
+]
+
+def generate(size, seed = 0, block = 1 << 18):
+    # Return about size bytes of text once encoded as UTF-8, ending on a
+    # line boundary. Large bodies repeat a block of random lines rather
+    # than generating every line afresh.
+
+    rng, lines, total = random.Random(seed), [], 0
+    while total < min(size, block):
+        line = rng.choice(kinds)(rng)
+        lines.append(line)
+        total += len(line.encode('utf-8')) + 1
+    text = u'\n'.join(lines) + u'\n'
+    return text * max(1, size // total)
+
+def bench_flow(text, data):
+    for line in text.split(u'\n'):
+        flow(line, width + 1)
+
+def bench_flow_bytes(text, data):
+    flow_bytes(data, width + 1)
+
+def bench_wrap(text, data):
+    for paragraph in text.split(u'\n\n'):
+        wrap(paragraph.expandtabs(), 0, width, True)
+
+def bench_balance(text, data):
+    for paragraph in text.split(u'\n\n'):
+        wrap(paragraph.expandtabs(), 0, width, True, True)
+
+def bench_encode(text, data):
+    encoding(scan(data))
+
+def bench_transfer(text, data):
+    cheapest(data, scan(data))
+
+def bench_render(text, data):
+    render(text)
+
+def bench_pbmbox(text, data):
+    pbmbox.write(devnull, data)
+
+def bench_reference(text, data):
+    for paragraph in text.split(u'\n\n'):
+        textwrap.fill(paragraph, width)
+
+benchmarks = [
+    ('flow', bench_flow),
+    ('flow_bytes', bench_flow_bytes),
+    ('wrap', bench_wrap),
+    ('balance', bench_balance),
+    ('encode', bench_encode),
+    ('transfer', bench_transfer),
+    ('render', bench_render),
+    ('pbmbox', bench_pbmbox),
+]
+
+def measure(function, text, data, minimum = 0.25, repeats = 1):
+    # Run function at least repeats times and for at least minimum seconds
+    # in total, returning the fastest run to keep noise from other load on
+    # the machine out of comparisons with the baseline.
+
+    fastest, total, runs = None, 0.0, 0
+    while runs < repeats or total < minimum:
+        start = tracing.clock()
+        function(text, data)
+        elapsed = tracing.clock() - start
+        fastest = elapsed if fastest is None else min(fastest, elapsed)
+        total, runs = total + elapsed, runs + 1
+    return fastest
+
+def peak(function, text, data):
+    # Return the most memory allocated at once during a single run, above
+    # what was allocated beforehand, or None without tracemalloc.
+
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        current = tracemalloc.get_traced_memory()[0]
+        function(text, data)
+        return tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+
+def machine():
+    # Identify the machine and interpreter results are measured on.
+    model = platform.processor()
+    if os.path.exists('/proc/cpuinfo'):
+        with open('/proc/cpuinfo') as source:
+            for line in source:
+                if line.startswith('model name'):
+                    model = line.split(':', 1)[1].strip()
+                    break
+    version = '.'.join(platform.python_version_tuple()[:2])
+    return {'host': platform.node(),
+            'platform': '%s %s' % (platform.system(), platform.machine()),
+            'processor': model,
+            'python': '%s %s' % (platform.python_implementation(), version)}
+
+def parse(size):
+    size = size.strip().upper()
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "b:mr:s:t:w",
+                                   ["bench=", "no-memory", "rounds=",
+                                    "sizes=", "threshold=",
+                                    "write-baseline"])
+        assert len(args) == 0
+        chosen, memory = [name for name, function in benchmarks], True
+        labels, threshold, save, rounds = sizes, 0.2, False, 5
+        for opt, arg in opts:
+            if opt in ("-b", "--bench"):
+                chosen = arg.split(',')
+                assert set(chosen) <= set(dict(benchmarks))
+            elif opt in ("-m", "--no-memory"):
+                memory = False
+            elif opt in ("-r", "--rounds"):
+                rounds = int(arg)
+                assert rounds > 0
+            elif opt in ("-s", "--sizes"):
+                labels = arg.split(',')
+                list(map(parse, labels))
+            elif opt in ("-t", "--threshold"):
+                threshold = float(arg)
+            elif opt in ("-w", "--write-baseline"):
+                save = True
+    except:
+        sys.stderr.write('''\
+Usage: %s [OPTIONS]
+Options:
+  -b, --bench=NAME,...      run only the named benchmarks from:
+                            %s
+  -m, --no-memory           skip measuring peak memory
+  -r, --rounds=COUNT        rounds of every benchmark to take the fastest
+                            from, default 5
+  -s, --sizes=SIZE,...      corpus sizes, default %s
+  -t, --threshold=FRACTION  slowdown treated as a regression, default 0.2
+  -w, --write-baseline      store the results as the new baseline
+''' % (sys.argv[0], ', '.join(name for name, function in benchmarks),
+       ','.join(sizes)))
+        sys.exit(64)
+
+    current, stored = machine(), {}
+    if os.path.exists(baseline):
+        with open(baseline) as source:
+            recorded = json.load(source)
+        if recorded.get('machine') == current:
+            stored = recorded['results']
+        else:
+            sys.stderr.write('Baseline recorded on %s, not compared\n'
+                             % json.dumps(recorded.get('machine'),
+                                          sort_keys = True))
+
+    sample = generate(16 << 10)
+    results, regressions = {}, []
+    print('%-12s %6s %10s %12s %10s %10s' % ('benchmark', 'size', 'MB/s',
+                                              'lines/s', 'peak MB',
+                                              'baseline'))
+    for label in labels:
+        text = generate(parse(label))
+        data = text.encode('utf-8')
+        lines = text.count(u'\n')
+
+        # Take rounds of the reference and every benchmark in turn, and
+        # keep the fastest run of each, so that the runs of each are spread
+        # out and the reference sees the same load as the benchmarks.
+
+        fastest = {}
+        for _ in range(rounds):
+            elapsed = measure(bench_reference, sample, None)
+            fastest[None] = min(fastest.get(None, elapsed), elapsed)
+            for name, function in benchmarks:
+                if name in chosen:
+                    elapsed = measure(function, text, data)
+                    fastest[name] = min(fastest.get(name, elapsed), elapsed)
+
+        key = 'reference %s' % label
+        speed = len(sample.encode('utf-8')) / fastest[None] / (1 << 20)
+        results[key] = round(speed, 2)
+        scale, change = 1.0, ''
+        if key in stored:
+            scale = stored[key] / speed
+            change = '%+.0f%%' % (100 * (speed / stored[key] - 1))
+        print('%-12s %6s %10.2f %12s %10s %10s'
+              % ('reference', label, speed, '-', '-', change))
+
+        for name, function in benchmarks:
+            if name not in chosen:
+                continue
+            elapsed = fastest[name]
+            used = peak(function, text, data) if memory else None
+            key = '%s %s' % (name, label)
+            rate = len(data) / elapsed / (1 << 20)
+            results[key] = round(rate, 2)
+
+            change = ''
+            if key in stored:
+                change = '%+.0f%%' % (100 * (rate * scale / stored[key] - 1))
+                if rate * scale < stored[key] * (1 - threshold):
+                    regressions.append(key)
+                    change += ' !'
+            print('%-12s %6s %10.2f %12.0f %10s %10s'
+                  % (name, label, rate, lines / elapsed,
+                     '-' if used is None else '%.1f' % (used / 1e6),
+                     change))
+            sys.stdout.flush()
+
+    if save:
+        stored.update(results)
+        with open(baseline, 'w') as target:
+            json.dump({'machine': current, 'results': stored}, target,
+                      indent = 2, sort_keys = True)
+            target.write('\n')
+    if regressions:
+        sys.stderr.write('Regressions beyond %d%%: %s\n'
+                         % (100 * threshold, ', '.join(regressions)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
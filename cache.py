@@ -0,0 +1,51 @@
+from collections import OrderedDict
+import threading
+import tracing
+
+class Cache(object):
+    # A least recently used cache holding at most limit bytes, as estimated
+    # by the caller for each entry. Mail regenerates the outgoing message
+    # on every draft autosave, so paragraphs left untouched since the last
+    # save are served from here rather than flowed again. Entries may also
+    # be added from a background thread, so every operation holds a lock.
+
+    def __init__(self, limit = 4 << 20):
+        self.entries, self.size, self.limit = OrderedDict(), 0, limit
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                tracing.count('cache misses')
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+        tracing.count('cache hits')
+        return entry[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            if size <= self.limit:
+                self.entries[key] = value, size
+                self.size += size
+                self.resize(self.limit)
+
+    def resize(self, limit):
+        # Evict the least recently used entries until within the limit.
+        with self.lock:
+            self.limit = limit
+            while self.size > limit and self.entries:
+                key, (value, size) = self.entries.popitem(last = False)
+                self.size -= size
+                self.evictions += 1
+                tracing.count('cache evictions')
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
@@ -0,0 +1,208 @@
+from array import array
+import bisect
+import re
+import sys
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+# Display widths of characters on a terminal: two columns for East Asian
+# wide and fullwidth characters, none for combining marks and invisible
+# format characters, and one for everything else. The table is a run of
+# (first code point, width) pairs, each run lasting up to the next, and is
+# generated by build(). Unassigned code points take the width of the run
+# they fall in, which keeps the table compact.
+
+table = (
+    0x00080, 1, 0x00300, 0, 0x00370, 1, 0x00483, 0, 0x0048a, 1, 0x00591, 0,
+    0x005be, 1, 0x005bf, 0, 0x005c0, 1, 0x005c1, 0, 0x005c3, 1, 0x005c4, 0,
+    0x005c6, 1, 0x005c7, 0, 0x005d0, 1, 0x00600, 0, 0x00606, 1, 0x00610, 0,
+    0x0061b, 1, 0x0061c, 0, 0x0061d, 1, 0x0064b, 0, 0x00660, 1, 0x00670, 0,
+    0x00671, 1, 0x006d6, 0, 0x006de, 1, 0x006df, 0, 0x006e5, 1, 0x006e7, 0,
+    0x006e9, 1, 0x006ea, 0, 0x006ee, 1, 0x0070f, 0, 0x00710, 1, 0x00711, 0,
+    0x00712, 1, 0x00730, 0, 0x0074d, 1, 0x007a6, 0, 0x007b1, 1, 0x007eb, 0,
+    0x007f4, 1, 0x007fd, 0, 0x007fe, 1, 0x00816, 0, 0x0081a, 1, 0x0081b, 0,
+    0x00824, 1, 0x00825, 0, 0x00828, 1, 0x00829, 0, 0x00830, 1, 0x00859, 0,
+    0x0085e, 1, 0x00890, 0, 0x008a0, 1, 0x008ca, 0, 0x00903, 1, 0x0093a, 0,
+    0x0093b, 1, 0x0093c, 0, 0x0093d, 1, 0x00941, 0, 0x00949, 1, 0x0094d, 0,
+    0x0094e, 1, 0x00951, 0, 0x00958, 1, 0x00962, 0, 0x00964, 1, 0x00981, 0,
+    0x00982, 1, 0x009bc, 0, 0x009bd, 1, 0x009c1, 0, 0x009c7, 1, 0x009cd, 0,
+    0x009ce, 1, 0x009e2, 0, 0x009e6, 1, 0x009fe, 0, 0x00a03, 1, 0x00a3c, 0,
+    0x00a3e, 1, 0x00a41, 0, 0x00a59, 1, 0x00a70, 0, 0x00a72, 1, 0x00a75, 0,
+    0x00a76, 1, 0x00a81, 0, 0x00a83, 1, 0x00abc, 0, 0x00abd, 1, 0x00ac1, 0,
+    0x00ac9, 1, 0x00acd, 0, 0x00ad0, 1, 0x00ae2, 0, 0x00ae6, 1, 0x00afa, 0,
+    0x00b02, 1, 0x00b3c, 0, 0x00b3d, 1, 0x00b3f, 0, 0x00b40, 1, 0x00b41, 0,
+    0x00b47, 1, 0x00b4d, 0, 0x00b57, 1, 0x00b62, 0, 0x00b66, 1, 0x00b82, 0,
+    0x00b83, 1, 0x00bc0, 0, 0x00bc1, 1, 0x00bcd, 0, 0x00bd0, 1, 0x00c00, 0,
+    0x00c01, 1, 0x00c04, 0, 0x00c05, 1, 0x00c3c, 0, 0x00c3d, 1, 0x00c3e, 0,
+    0x00c41, 1, 0x00c46, 0, 0x00c58, 1, 0x00c62, 0, 0x00c66, 1, 0x00c81, 0,
+    0x00c82, 1, 0x00cbc, 0, 0x00cbd, 1, 0x00cbf, 0, 0x00cc0, 1, 0x00cc6, 0,
+    0x00cc7, 1, 0x00ccc, 0, 0x00cd5, 1, 0x00ce2, 0, 0x00ce6, 1, 0x00d00, 0,
+    0x00d02, 1, 0x00d3b, 0, 0x00d3d, 1, 0x00d41, 0, 0x00d46, 1, 0x00d4d, 0,
+    0x00d4e, 1, 0x00d62, 0, 0x00d66, 1, 0x00d81, 0, 0x00d82, 1, 0x00dca, 0,
+    0x00dcf, 1, 0x00dd2, 0, 0x00dd8, 1, 0x00e31, 0, 0x00e32, 1, 0x00e34, 0,
+    0x00e3f, 1, 0x00e47, 0, 0x00e4f, 1, 0x00eb1, 0, 0x00eb2, 1, 0x00eb4, 0,
+    0x00ebd, 1, 0x00ec8, 0, 0x00ed0, 1, 0x00f18, 0, 0x00f1a, 1, 0x00f35, 0,
+    0x00f36, 1, 0x00f37, 0, 0x00f38, 1, 0x00f39, 0, 0x00f3a, 1, 0x00f71, 0,
+    0x00f7f, 1, 0x00f80, 0, 0x00f85, 1, 0x00f86, 0, 0x00f88, 1, 0x00f8d, 0,
+    0x00fbe, 1, 0x00fc6, 0, 0x00fc7, 1, 0x0102d, 0, 0x01031, 1, 0x01032, 0,
+    0x01038, 1, 0x01039, 0, 0x0103b, 1, 0x0103d, 0, 0x0103f, 1, 0x01058, 0,
+    0x0105a, 1, 0x0105e, 0, 0x01061, 1, 0x01071, 0, 0x01075, 1, 0x01082, 0,
+    0x01083, 1, 0x01085, 0, 0x01087, 1, 0x0108d, 0, 0x0108e, 1, 0x0109d, 0,
+    0x0109e, 1, 0x01100, 2, 0x01160, 1, 0x0135d, 0, 0x01360, 1, 0x01712, 0,
+    0x01715, 1, 0x01732, 0, 0x01734, 1, 0x01752, 0, 0x01760, 1, 0x01772, 0,
+    0x01780, 1, 0x017b4, 0, 0x017b6, 1, 0x017b7, 0, 0x017be, 1, 0x017c6, 0,
+    0x017c7, 1, 0x017c9, 0, 0x017d4, 1, 0x017dd, 0, 0x017e0, 1, 0x0180b, 0,
+    0x01810, 1, 0x01885, 0, 0x01887, 1, 0x018a9, 0, 0x018aa, 1, 0x01920, 0,
+    0x01923, 1, 0x01927, 0, 0x01929, 1, 0x01932, 0, 0x01933, 1, 0x01939, 0,
+    0x01940, 1, 0x01a17, 0, 0x01a19, 1, 0x01a1b, 0, 0x01a1e, 1, 0x01a56, 0,
+    0x01a57, 1, 0x01a58, 0, 0x01a61, 1, 0x01a62, 0, 0x01a63, 1, 0x01a65, 0,
+    0x01a6d, 1, 0x01a73, 0, 0x01a80, 1, 0x01ab0, 0, 0x01b04, 1, 0x01b34, 0,
+    0x01b35, 1, 0x01b36, 0, 0x01b3b, 1, 0x01b3c, 0, 0x01b3d, 1, 0x01b42, 0,
+    0x01b43, 1, 0x01b6b, 0, 0x01b74, 1, 0x01b80, 0, 0x01b82, 1, 0x01ba2, 0,
+    0x01ba6, 1, 0x01ba8, 0, 0x01baa, 1, 0x01bab, 0, 0x01bae, 1, 0x01be6, 0,
+    0x01be7, 1, 0x01be8, 0, 0x01bea, 1, 0x01bed, 0, 0x01bee, 1, 0x01bef, 0,
+    0x01bf2, 1, 0x01c2c, 0, 0x01c34, 1, 0x01c36, 0, 0x01c3b, 1, 0x01cd0, 0,
+    0x01cd3, 1, 0x01cd4, 0, 0x01ce1, 1, 0x01ce2, 0, 0x01ce9, 1, 0x01ced, 0,
+    0x01cee, 1, 0x01cf4, 0, 0x01cf5, 1, 0x01cf8, 0, 0x01cfa, 1, 0x01dc0, 0,
+    0x01e00, 1, 0x0200b, 0, 0x02010, 1, 0x0202a, 0, 0x0202f, 1, 0x02060, 0,
+    0x02070, 1, 0x020d0, 0, 0x02100, 1, 0x0231a, 2, 0x0231c, 1, 0x02329, 2,
+    0x0232b, 1, 0x023e9, 2, 0x023ed, 1, 0x023f0, 2, 0x023f1, 1, 0x023f3, 2,
+    0x023f4, 1, 0x025fd, 2, 0x025ff, 1, 0x02614, 2, 0x02616, 1, 0x02648, 2,
+    0x02654, 1, 0x0267f, 2, 0x02680, 1, 0x02693, 2, 0x02694, 1, 0x026a1, 2,
+    0x026a2, 1, 0x026aa, 2, 0x026ac, 1, 0x026bd, 2, 0x026bf, 1, 0x026c4, 2,
+    0x026c6, 1, 0x026ce, 2, 0x026cf, 1, 0x026d4, 2, 0x026d5, 1, 0x026ea, 2,
+    0x026eb, 1, 0x026f2, 2, 0x026f4, 1, 0x026f5, 2, 0x026f6, 1, 0x026fa, 2,
+    0x026fb, 1, 0x026fd, 2, 0x026fe, 1, 0x02705, 2, 0x02706, 1, 0x0270a, 2,
+    0x0270c, 1, 0x02728, 2, 0x02729, 1, 0x0274c, 2, 0x0274d, 1, 0x0274e, 2,
+    0x0274f, 1, 0x02753, 2, 0x02756, 1, 0x02757, 2, 0x02758, 1, 0x02795, 2,
+    0x02798, 1, 0x027b0, 2, 0x027b1, 1, 0x027bf, 2, 0x027c0, 1, 0x02b1b, 2,
+    0x02b1d, 1, 0x02b50, 2, 0x02b51, 1, 0x02b55, 2, 0x02b56, 1, 0x02cef, 0,
+    0x02cf2, 1, 0x02d7f, 0, 0x02d80, 1, 0x02de0, 0, 0x02e00, 1, 0x02e80, 2,
+    0x0302a, 0, 0x0302e, 2, 0x0303f, 1, 0x03041, 2, 0x03099, 0, 0x0309b, 2,
+    0x03248, 1, 0x03250, 2, 0x04dc0, 1, 0x04e00, 2, 0x0a4d0, 1, 0x0a66f, 0,
+    0x0a673, 1, 0x0a674, 0, 0x0a67e, 1, 0x0a69e, 0, 0x0a6a0, 1, 0x0a6f0, 0,
+    0x0a6f2, 1, 0x0a802, 0, 0x0a803, 1, 0x0a806, 0, 0x0a807, 1, 0x0a80b, 0,
+    0x0a80c, 1, 0x0a825, 0, 0x0a827, 1, 0x0a82c, 0, 0x0a830, 1, 0x0a8c4, 0,
+    0x0a8ce, 1, 0x0a8e0, 0, 0x0a8f2, 1, 0x0a8ff, 0, 0x0a900, 1, 0x0a926, 0,
+    0x0a92e, 1, 0x0a947, 0, 0x0a952, 1, 0x0a960, 2, 0x0a980, 0, 0x0a983, 1,
+    0x0a9b3, 0, 0x0a9b4, 1, 0x0a9b6, 0, 0x0a9ba, 1, 0x0a9bc, 0, 0x0a9be, 1,
+    0x0a9e5, 0, 0x0a9e6, 1, 0x0aa29, 0, 0x0aa2f, 1, 0x0aa31, 0, 0x0aa33, 1,
+    0x0aa35, 0, 0x0aa40, 1, 0x0aa43, 0, 0x0aa44, 1, 0x0aa4c, 0, 0x0aa4d, 1,
+    0x0aa7c, 0, 0x0aa7d, 1, 0x0aab0, 0, 0x0aab1, 1, 0x0aab2, 0, 0x0aab5, 1,
+    0x0aab7, 0, 0x0aab9, 1, 0x0aabe, 0, 0x0aac0, 1, 0x0aac1, 0, 0x0aac2, 1,
+    0x0aaec, 0, 0x0aaee, 1, 0x0aaf6, 0, 0x0ab01, 1, 0x0abe5, 0, 0x0abe6, 1,
+    0x0abe8, 0, 0x0abe9, 1, 0x0abed, 0, 0x0abf0, 1, 0x0ac00, 2, 0x0d7b0, 1,
+    0x0f900, 2, 0x0fb00, 1, 0x0fb1e, 0, 0x0fb1f, 1, 0x0fe00, 0, 0x0fe10, 2,
+    0x0fe20, 0, 0x0fe30, 2, 0x0fe70, 1, 0x0feff, 0, 0x0ff01, 2, 0x0ff61, 1,
+    0x0ffe0, 2, 0x0ffe8, 1, 0x0fff9, 0, 0x0fffc, 1, 0x101fd, 0, 0x10280, 1,
+    0x102e0, 0, 0x102e1, 1, 0x10376, 0, 0x10380, 1, 0x10a01, 0, 0x10a10, 1,
+    0x10a38, 0, 0x10a40, 1, 0x10ae5, 0, 0x10aeb, 1, 0x10d24, 0, 0x10d30, 1,
+    0x10eab, 0, 0x10ead, 1, 0x10f46, 0, 0x10f51, 1, 0x10f82, 0, 0x10f86, 1,
+    0x11001, 0, 0x11002, 1, 0x11038, 0, 0x11047, 1, 0x11070, 0, 0x11071, 1,
+    0x11073, 0, 0x11075, 1, 0x1107f, 0, 0x11082, 1, 0x110b3, 0, 0x110b7, 1,
+    0x110b9, 0, 0x110bb, 1, 0x110bd, 0, 0x110be, 1, 0x110c2, 0, 0x110d0, 1,
+    0x11100, 0, 0x11103, 1, 0x11127, 0, 0x1112c, 1, 0x1112d, 0, 0x11136, 1,
+    0x11173, 0, 0x11174, 1, 0x11180, 0, 0x11182, 1, 0x111b6, 0, 0x111bf, 1,
+    0x111c9, 0, 0x111cd, 1, 0x111cf, 0, 0x111d0, 1, 0x1122f, 0, 0x11232, 1,
+    0x11234, 0, 0x11235, 1, 0x11236, 0, 0x11238, 1, 0x1123e, 0, 0x11280, 1,
+    0x112df, 0, 0x112e0, 1, 0x112e3, 0, 0x112f0, 1, 0x11300, 0, 0x11302, 1,
+    0x1133b, 0, 0x1133d, 1, 0x11340, 0, 0x11341, 1, 0x11366, 0, 0x11400, 1,
+    0x11438, 0, 0x11440, 1, 0x11442, 0, 0x11445, 1, 0x11446, 0, 0x11447, 1,
+    0x1145e, 0, 0x1145f, 1, 0x114b3, 0, 0x114b9, 1, 0x114ba, 0, 0x114bb, 1,
+    0x114bf, 0, 0x114c1, 1, 0x114c2, 0, 0x114c4, 1, 0x115b2, 0, 0x115b8, 1,
+    0x115bc, 0, 0x115be, 1, 0x115bf, 0, 0x115c1, 1, 0x115dc, 0, 0x11600, 1,
+    0x11633, 0, 0x1163b, 1, 0x1163d, 0, 0x1163e, 1, 0x1163f, 0, 0x11641, 1,
+    0x116ab, 0, 0x116ac, 1, 0x116ad, 0, 0x116ae, 1, 0x116b0, 0, 0x116b6, 1,
+    0x116b7, 0, 0x116b8, 1, 0x1171d, 0, 0x11720, 1, 0x11722, 0, 0x11726, 1,
+    0x11727, 0, 0x11730, 1, 0x1182f, 0, 0x11838, 1, 0x11839, 0, 0x1183b, 1,
+    0x1193b, 0, 0x1193d, 1, 0x1193e, 0, 0x1193f, 1, 0x11943, 0, 0x11944, 1,
+    0x119d4, 0, 0x119dc, 1, 0x119e0, 0, 0x119e1, 1, 0x11a01, 0, 0x11a0b, 1,
+    0x11a33, 0, 0x11a39, 1, 0x11a3b, 0, 0x11a3f, 1, 0x11a47, 0, 0x11a50, 1,
+    0x11a51, 0, 0x11a57, 1, 0x11a59, 0, 0x11a5c, 1, 0x11a8a, 0, 0x11a97, 1,
+    0x11a98, 0, 0x11a9a, 1, 0x11c30, 0, 0x11c3e, 1, 0x11c3f, 0, 0x11c40, 1,
+    0x11c92, 0, 0x11ca9, 1, 0x11caa, 0, 0x11cb1, 1, 0x11cb2, 0, 0x11cb4, 1,
+    0x11cb5, 0, 0x11d00, 1, 0x11d31, 0, 0x11d46, 1, 0x11d47, 0, 0x11d50, 1,
+    0x11d90, 0, 0x11d93, 1, 0x11d95, 0, 0x11d96, 1, 0x11d97, 0, 0x11d98, 1,
+    0x11ef3, 0, 0x11ef5, 1, 0x13430, 0, 0x14400, 1, 0x16af0, 0, 0x16af5, 1,
+    0x16b30, 0, 0x16b37, 1, 0x16f4f, 0, 0x16f50, 1, 0x16f8f, 0, 0x16f93, 1,
+    0x16fe0, 2, 0x16fe4, 0, 0x16ff0, 2, 0x1bc00, 1, 0x1bc9d, 0, 0x1bc9f, 1,
+    0x1bca0, 0, 0x1cf50, 1, 0x1d167, 0, 0x1d16a, 1, 0x1d173, 0, 0x1d183, 1,
+    0x1d185, 0, 0x1d18c, 1, 0x1d1aa, 0, 0x1d1ae, 1, 0x1d242, 0, 0x1d245, 1,
+    0x1da00, 0, 0x1da37, 1, 0x1da3b, 0, 0x1da6d, 1, 0x1da75, 0, 0x1da76, 1,
+    0x1da84, 0, 0x1da85, 1, 0x1da9b, 0, 0x1df00, 1, 0x1e000, 0, 0x1e100, 1,
+    0x1e130, 0, 0x1e137, 1, 0x1e2ae, 0, 0x1e2c0, 1, 0x1e2ec, 0, 0x1e2f0, 1,
+    0x1e8d0, 0, 0x1e900, 1, 0x1e944, 0, 0x1e94b, 1, 0x1f004, 2, 0x1f005, 1,
+    0x1f0cf, 2, 0x1f0d1, 1, 0x1f18e, 2, 0x1f18f, 1, 0x1f191, 2, 0x1f19b, 1,
+    0x1f200, 2, 0x1f321, 1, 0x1f32d, 2, 0x1f336, 1, 0x1f337, 2, 0x1f37d, 1,
+    0x1f37e, 2, 0x1f394, 1, 0x1f3a0, 2, 0x1f3cb, 1, 0x1f3cf, 2, 0x1f3d4, 1,
+    0x1f3e0, 2, 0x1f3f1, 1, 0x1f3f4, 2, 0x1f3f5, 1, 0x1f3f8, 2, 0x1f43f, 1,
+    0x1f440, 2, 0x1f441, 1, 0x1f442, 2, 0x1f4fd, 1, 0x1f4ff, 2, 0x1f53e, 1,
+    0x1f54b, 2, 0x1f54f, 1, 0x1f550, 2, 0x1f568, 1, 0x1f57a, 2, 0x1f57b, 1,
+    0x1f595, 2, 0x1f597, 1, 0x1f5a4, 2, 0x1f5a5, 1, 0x1f5fb, 2, 0x1f650, 1,
+    0x1f680, 2, 0x1f6c6, 1, 0x1f6cc, 2, 0x1f6cd, 1, 0x1f6d0, 2, 0x1f6d3, 1,
+    0x1f6d5, 2, 0x1f6e0, 1, 0x1f6eb, 2, 0x1f6f0, 1, 0x1f6f4, 2, 0x1f700, 1,
+    0x1f7e0, 2, 0x1f800, 1, 0x1f90c, 2, 0x1f93b, 1, 0x1f93c, 2, 0x1f946, 1,
+    0x1f947, 2, 0x1fa00, 1, 0x1fa70, 2, 0x1fb00, 1, 0x20000, 2, 0xe0001, 0,
+    0xf0000, 1,
+)
+
+starts, sizes = array('I', table[0::2]), array('B', table[1::2])
+
+def width(code):
+    if code < 0x300:
+        return 1
+    return sizes[bisect.bisect_right(starts, code) - 1]
+
+def build():
+    # Regenerate the table from the unicodedata module of this Python.
+    import unicodedata
+    runs = [0x80, 1]
+    for code in range(0x80, sys.maxunicode + 1):
+        char = unichr(code)
+        category = unicodedata.category(char)
+        if category == 'Cn':
+            continue
+        if category in ('Mn', 'Me') or category == 'Cf' and code != 0xad:
+            size = 0
+        elif unicodedata.east_asian_width(char) in ('W', 'F'):
+            size = 2
+        else:
+            size = 1
+        if size != runs[-1]:
+            runs += [code, size]
+    return tuple(runs)
+
+def ranges(size, first = 0, last = 0x10ffff):
+    # Yield the code point ranges of a width, clipped to first and last.
+    for index in range(len(starts)):
+        low = starts[index]
+        high = starts[index + 1] - 1 if index + 1 < len(starts) else 0x10ffff
+        if sizes[index] == size and low <= last and high >= first:
+            yield max(low, first), min(high, last)
+
+def characters(size, first = 0x300, last = 0x10ffff):
+    # A class matching the characters of a width between first and last.
+    return u'[%s]' % u''.join(u'%s-%s' % (re.escape(unichr(low)),
+                                          re.escape(unichr(high)))
+                              for low, high in ranges(size, first, last))
+
+# Large classes are quick for re to test when they lie within the BMP, so
+# runs of each width are matched by one pattern which looks only there and
+# another, slower one which goes beyond, used when astral is found. On a
+# narrow Python 2 build characters beyond the BMP are surrogate pairs,
+# which already take two columns, so the BMP is all there is.
+
+if sys.maxunicode > 0xffff:
+    astral = re.compile(u'[\U00010000-\U0010ffff]')
+else:
+    astral = None
+
+def runs(size):
+    basic = re.compile(characters(size, last = 0xffff) + u'+')
+    if astral is None:
+        return basic, basic
+    return basic, re.compile(u'(?:%s|%s)+' % (characters(size, last = 0xffff),
+                                              characters(size, 0x10000)))
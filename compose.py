@@ -0,0 +1,250 @@
+from collections import namedtuple
+from difflib import SequenceMatcher
+from flowtext import wrap
+import re
+
+# A plain text message body as shown in the compose view, read in a single
+# walk of its DOM. Each displayed line has a quote level and text, and the
+# DOM positions just before its first character and after its last, which
+# are None for lines without any text.
+
+Line = namedtuple('Line', 'level text start end')
+Block = namedtuple('Block', 'start stop level')
+
+TEXT, ELEMENT = 3, 1
+blocks = ('BLOCKQUOTE', 'DIV', 'P')
+
+class Snapshot(object):
+    # Alongside the lines, record where each piece of text came from, so
+    # DOM positions can be converted to and from line and column.
+
+    def __init__(self, root, level = 0):
+        self.lines, self.places, self.nodes = [], [], {}
+        self.level, self.parts, self.start, self.end = level, [], None, None
+        self.open, self.column, self.pieces = False, 0, []
+        self.walk(root, level)
+        if self.open:
+            self.close()
+
+    def close(self):
+        self.lines.append(Line(self.level, u''.join(self.parts),
+                               self.start, self.end))
+        self.places.append(self.pieces)
+        self.parts, self.start, self.end = [], None, None
+        self.open, self.column, self.pieces = False, 0, []
+
+    def begin(self, level):
+        if not self.open:
+            self.level, self.open = level, True
+
+    def walk(self, node, level):
+        # Text nodes add to the current line, breaking it at any newlines,
+        # and a BR element ends it. Block elements start a new line unless
+        # the current one is empty, and BLOCKQUOTE raises the quote level
+        # of everything inside.
+
+        child = node.firstChild()
+        while child is not None:
+            kind = child.nodeType()
+            if kind == TEXT:
+                data, offset = child.data(), 0
+                while True:
+                    stop = data.find(u'\n', offset)
+                    end = len(data) if stop < 0 else stop
+                    if end > offset:
+                        self.begin(level)
+                        if self.start is None:
+                            self.start = (child, offset)
+                        self.end = (child, end)
+                        self.parts.append(data[offset:end])
+                        self.pieces.append((self.column, child, offset,
+                                            end - offset))
+                        self.nodes.setdefault(child, []).append(
+                            (offset, len(self.lines), self.column))
+                        self.column += end - offset
+                    if stop < 0:
+                        break
+                    self.begin(level)
+                    self.close()
+                    offset = stop + 1
+            elif kind == ELEMENT:
+                name = child.nodeName().upper()
+                if name == 'BR':
+                    self.begin(level)
+                    self.close()
+                elif name in blocks:
+                    if self.open:
+                        self.close()
+                    self.walk(child, level + (name == 'BLOCKQUOTE'))
+                    if self.open:
+                        self.close()
+                else:
+                    self.walk(child, level)
+            child = child.nextSibling()
+
+    def locate(self, node, offset):
+        # Return the line and column of a DOM position within a text node,
+        # or None if the position is anywhere else.
+
+        for start, line, column in reversed(self.nodes.get(node, ())):
+            if start <= offset:
+                return line, column + offset - start
+        return None
+
+    def position(self, line, column):
+        # Return the DOM position of a column within a line, or None if
+        # the line has no text.
+
+        for start, node, offset, length in reversed(self.places[line]):
+            if start <= column:
+                return node, offset + min(column - start, length)
+        return None
+
+def snapshot(root, level = 0):
+    return Snapshot(root, level).lines
+
+def enclosing(root, node):
+    # Return the innermost block element around node within root and the
+    # quote level of its contents, or None if there is no such block. A
+    # block always starts and ends a line, so a snapshot of it alone reads
+    # the same lines as the whole body does there.
+
+    block, level = None, 0
+    while node is not None and node != root:
+        if node.nodeType() == ELEMENT:
+            name = node.nodeName().upper()
+            if name in blocks and block is None:
+                block = node
+            if block is not None and name == 'BLOCKQUOTE':
+                level += 1
+        node = node.parentNode()
+    if node is None or block is None:
+        return None
+    return block, level
+
+def plain(lines):
+    # The lines as Mail writes them into a plain text part when sending,
+    # with quoted lines prefixed by '>' for each level and a space.
+
+    return [u'>' * line.level + u' ' + line.text if line.level
+            else line.text for line in lines]
+
+def paragraphs(lines):
+    # Split the lines into paragraph blocks, each ended by a blank line, a
+    # change in quote level or the end of the message.
+
+    start = None
+    for index, line in enumerate(lines):
+        if start is not None:
+            if not line.text.strip() or line.level != lines[start].level:
+                yield Block(start, index, lines[start].level)
+                start = None
+        if start is None and line.text.strip():
+            start = index
+    if start is not None:
+        yield Block(start, len(lines), lines[start].level)
+
+def search(blocks, test):
+    # Return the index of the first block passing test, which every block
+    # after it must pass too, or len(blocks) if none does.
+
+    low, high = 0, len(blocks)
+    while low < high:
+        middle = (low + high) // 2
+        if test(blocks[middle]):
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+def following(lines, blocks, compare):
+    # Return the index of the first block after a selection, where
+    # compare(position) is -1, 0 or 1 as a DOM position falls before,
+    # within or after it.
+
+    return search(blocks, lambda block: compare(lines[block.start].start) > 0)
+
+def overlapping(lines, blocks, compare):
+    # Return the blocks touching a selection. The blocks are in document
+    # order, so each end is found by bisection.
+
+    first = search(blocks,
+                   lambda block: compare(lines[block.stop - 1].end) >= 0)
+    return blocks[first:following(lines, blocks, compare)]
+
+def refill(lines, block, width, detect_bullet_list, optimal = False,
+           cache = None):
+    text = u'\n'.join(line.text for line in lines[block.start:block.stop])
+    return wrap(text.expandtabs(), block.level, width, detect_bullet_list,
+                optimal, cache)
+
+def changes(lines, block, text):
+    # Compare the refilled text of a block with its current lines and
+    # return a list of (start, stop, text) edits replacing lines[start:stop]
+    # which turn one into the other, leaving every unchanged line alone.
+    # An edit only inserting or deleting lines is widened to cover an
+    # unchanged neighbour, so each replaces a range with some text, and
+    # edits which then touch are merged.
+
+    old = [line.text.replace(u'\xa0', u' ')
+           for line in lines[block.start:block.stop]]
+    new = text.split(u'\n')
+    if old == new:
+        return []
+
+    edits = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, old, new,
+                                               False).get_opcodes():
+        if tag == 'equal':
+            continue
+        if i1 == i2 or j1 == j2:
+            if i1 > 0:
+                i1, j1 = i1 - 1, j1 - 1
+            else:
+                i2, j2 = i2 + 1, j2 + 1
+        if edits and edits[-1][1] >= i1:
+            i1, j1 = edits[-1][0], edits[-1][2]
+            edits.pop()
+        edits.append((i1, i2, j1, j2))
+    return [(block.start + i1, block.start + i2, u'\n'.join(new[j1:j2]))
+            for i1, i2, j1, j2 in edits]
+
+def reindent(text, width, outdent = False):
+    # Return the text with width spaces added to or removed from the start
+    # of the line, and the change in length. Empty lines are never
+    # indented and lines are only outdented if they begin with enough
+    # spaces, which may be non-breaking.
+
+    if outdent:
+        if re.match(u'[ \xa0]{%d}' % width, text, re.UNICODE):
+            return text[width:], -width
+    elif text:
+        return u' ' * width + text, width
+    return text, 0
+
+def indentation(lines, start, stop, width, outdent = False):
+    # Reindent lines[start:stop], returning a list of (start, stop, text)
+    # edits and the change in length of each line. Text inserted in the
+    # compose view takes the quote level of the place it is inserted, so
+    # there is one edit for each run of lines at the same quote level,
+    # spanning the changed lines in that run.
+
+    edits, shifts, texts = [], {}, {}
+    first = last = None
+    for index in range(start, stop + 1):
+        if index == stop or first is not None \
+                and lines[index].level != lines[first].level:
+            if first is not None:
+                edits.append((first, last + 1,
+                              u'\n'.join(texts[line]
+                                         for line in range(first, last + 1))))
+            first = last = None
+            if index == stop:
+                break
+        texts[index], shifts[index] = reindent(lines[index].text, width,
+                                               outdent)
+        if shifts[index]:
+            if first is None:
+                first = index
+            last = index
+    return edits, shifts
@@ -0,0 +1,89 @@
+from collections import namedtuple
+from flowtext import flow, layout
+import re
+
+# A logical paragraph of a format=flowed body: the quote prefix exactly as
+# it appeared on its first line, the quote depth, the unstuffed text with
+# soft line breaks removed, and whether any soft breaks were joined.
+
+Paragraph = namedtuple('Paragraph', 'quote depth text flowed')
+
+prefix = re.compile(r'(>*)( ?)')
+
+def paragraphs(lines, delsp=False):
+    # Decode RFC 3676 format=flowed lines into logical paragraphs. Lines
+    # may be any iterable, such as an open file, and each paragraph is
+    # yielded as soon as its last line has been read.
+
+    parts, quote, depth = [], None, None
+    for line in lines:
+        if line.endswith(u'\n'):
+            line = line[:-2] if line.endswith(u'\r\n') else line[:-1]
+
+        # A line of nothing but spaces is kept as it is rather than
+        # unstuffed. It is always fixed, as flow() never breaks a line
+        # there, and flowing it again stuffs it back to the same.
+
+        match = prefix.match(line)
+        blank = not match.group(1) and not line.strip(u' ')
+        if match.group(1):
+            lead, text = line[:match.end()], line[match.end():]
+        else:
+            lead, text = u'', line if blank else line[match.end():]
+        level = len(match.group(1))
+
+        # A flowed line followed by one at a different quote depth is
+        # treated as fixed, so it keeps its trailing space.
+
+        if parts and level != depth:
+            yield join(parts, quote, depth, delsp)
+            parts = []
+        if not parts:
+            quote, depth = lead, level
+
+        # Without DelSp a soft break after a word '--' leaves a bare '-- ',
+        # so there it continues the paragraph. With DelSp the break would
+        # carry a second space, and '-- ' is always a signature separator.
+
+        signature = text == u'-- ' and (delsp or not parts)
+        parts.append(text)
+
+        if not text.endswith(u' ') or signature or blank:
+            yield join(parts, quote, depth, delsp)
+            parts = []
+    if parts:
+        yield join(parts, quote, depth, delsp)
+
+def join(parts, quote, depth, delsp):
+    if delsp:
+        text = u''.join(part[:-1] for part in parts[:-1])
+    else:
+        text = u''.join(parts[:-1])
+    return Paragraph(quote, depth, text + parts[-1], len(parts) > 1)
+
+def reflow(lines, width, delsp=False, padspace=True):
+    # Re-encode a format=flowed body at a different width. Flowing the
+    # output of flow() back through here at the same width reproduces it
+    # exactly.
+
+    for paragraph in paragraphs(lines, delsp):
+        for line in flow(paragraph.quote + paragraph.text, width, padspace):
+            yield line
+
+def fill(paragraph, width):
+    # Fill a paragraph for display, breaking between words as flow() does
+    # but without the space stuffing and soft-break spaces of the wire
+    # format. Indented paragraphs are left as they are.
+
+    text = paragraph.quote + paragraph.text
+    spans = layout(text, 0, len(text), width)
+    lines = [text[start:end].rstrip(u' ') for head, start, end in spans]
+    return [lines[0]] + [paragraph.quote + line for line in lines[1:]]
+
+def refill(paragraphs, width):
+    # Lazily fill a sequence of decoded paragraphs, so a viewer only pays
+    # for the lines it actually shows after a change of width.
+
+    for paragraph in paragraphs:
+        for line in fill(paragraph, width):
+            yield line
@@ -0,0 +1,669 @@
+from array import array
+import bisect
+import columns
+import hashlib
+import re
+
+try:
+    view = buffer
+except NameError:
+    view = memoryview
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+def runs(matches):
+    # Collect matched runs as a flat array of their start and end offsets,
+    # alongside the number of units in all the runs before each.
+
+    bounds, before, total = array('I'), array('I', [0]), 0
+    for match in matches:
+        start, end = match.span()
+        bounds.append(start)
+        bounds.append(end)
+        total += end - start
+        before.append(total)
+    return bounds, before
+
+def covered(marked, offset):
+    # The number of units before offset which fall within the runs.
+    bounds, before = marked
+    index = bisect.bisect_right(bounds, offset)
+    if index & 1:
+        return before[index >> 1] + offset - bounds[index - 1]
+    return before[index >> 1]
+
+class Text(object):
+    # Patterns and measurements used by Paragraph on unicode strings. Line
+    # lengths are counted in terminal columns, with tabs expanded to eight
+    # columns exactly as str.expandtabs() would. Wide East Asian characters
+    # take two columns and combining marks none, but nothing before U+0300
+    # is ever either, so most lines are measured by their length alone.
+
+    space, empty, linefeed = u' ', u'', u'\n'
+    lead = re.compile(r'(>+ ?|)( ?)(\s*)', re.UNICODE)
+    words = re.compile(r'\S+', re.UNICODE)
+    leading = re.compile(r'\S+\s*', re.UNICODE)
+    stripped = re.compile(r'.*[^ ]', re.DOTALL)
+    signature = re.compile(r'-- \Z')
+    escape = re.compile(r'From ')
+    stuffed = re.compile(r'From |>')
+    nested = re.compile(r'>')
+    controls = re.compile(u'[\t\n\r]')
+    beyond = re.compile(u'[^\x00-\u02ff]')
+    zero, wide = columns.runs(0), columns.runs(2)
+    reach = u'.{0,%d}(?:\\Z|(?<=\\s)(?=\\S))'
+    filled, word = u'.{0,%d}(?= |\\Z)', re.compile(u'[^ ]*')
+    flags = re.DOTALL | re.UNICODE
+
+    def __init__(self):
+        self.patterns = {}
+
+    def compile(self, template, size):
+        if (template, size) not in self.patterns:
+            self.patterns[template, size] = re.compile(template % size,
+                                                       self.flags)
+        return self.patterns[template, size]
+
+    def fitter(self, text, start, end):
+        # Return a function giving the last word boundary in text[:end]
+        # which is at most size characters beyond a given offset, for text
+        # in which every character is one column.
+
+        def fit(offset, size):
+            match = self.compile(self.reach, size).match(text, offset, end)
+            return match.end() if match else offset
+        return fit
+
+    def count(self, text, start, end):
+        found = self.beyond.search(text, start, end)
+        if found is None:
+            return end - start
+        astral = self.astral(text, found.start(), end)
+        zero = self.zero[astral].findall(text, found.start(), end)
+        wide = self.wide[astral].findall(text, found.start(), end)
+        return end - start - len(u''.join(zero)) + len(u''.join(wide))
+
+    def uniform(self, text, start, end):
+        return self.beyond.search(text, start, end) is None
+
+    def index(self, text, start, end):
+        spans = [word.span() for word in self.words.finditer(text, start, end)]
+        return (array('I', [span[0] for span in spans]),
+                array('I', [span[1] for span in spans]))
+
+    def marks(self, text, start, end):
+        # Runs of characters in text[start:end] taking no column and runs
+        # taking two, or None if every character takes one. None can come
+        # before the first character from U+0300 on, so the runs are only
+        # looked for from there.
+
+        found = self.beyond.search(text, start, end)
+        if found is None:
+            return None
+        start = found.start()
+        astral = self.astral(text, start, end)
+        zero = runs(self.zero[astral].finditer(text, start, end))
+        wide = runs(self.wide[astral].finditer(text, start, end))
+        return (zero, wide) if zero[0] or wide[0] else None
+
+    def astral(self, text, start, end):
+        return columns.astral is not None \
+            and columns.astral.search(text, start, end) is not None
+
+    def columns(self, marks, start, end):
+        zero, wide = marks
+        return end - start - covered(zero, end) + covered(zero, start) \
+            + covered(wide, end) - covered(wide, start)
+
+    def fit(self, ends, lo, start, room, marks):
+        # Find the first offset in ends[lo:] at least room columns on from
+        # start, in text without tabs or line breaks, bisecting on the
+        # column of each offset if any characters are not one column wide.
+
+        if marks is None:
+            return bisect.bisect_left(ends, start + room, lo)
+        hi = len(ends)
+        while lo < hi:
+            middle = (lo + hi) // 2
+            if self.columns(marks, start, ends[middle]) < room:
+                lo = middle + 1
+            else:
+                hi = middle
+        return lo
+
+    def widths(self, starts, ends, marks):
+        # Start from the length of each word, then adjust just the words
+        # overlapping a run of zero-width or wide characters.
+
+        widths = array('I', [end - start for start, end in zip(starts, ends)])
+        for (bounds, _), sign in zip(marks or (), (-1, 1)):
+            for index in range(0, len(bounds), 2):
+                low, high = bounds[index], bounds[index + 1]
+                for word in range(bisect.bisect_right(ends, low),
+                                  bisect.bisect_left(starts, high)):
+                    widths[word] += sign * (min(ends[word], high)
+                                            - max(starts[word], low))
+        return widths
+
+    def codes(self, text, start, end):
+        return (ord(char) for char in text[start:end])
+
+    def advance(self, text, start, end, length, column, tabsize = 8):
+        # Step the length and column of text[:start].expandtabs() on to
+        # text[:end], following the same rules as str.expandtabs().
+
+        for code in self.codes(text, start, end):
+            if code == 9:
+                step = tabsize - column % tabsize
+                length, column = length + step, column + step
+            elif code == 10 or code == 13:
+                length, column = length + 1, 0
+            else:
+                step = 1 if code < 0x300 else columns.width(code)
+                length, column = length + step, column + step
+        return length, column
+
+class UTF8(Text):
+    # The same rules applied directly to UTF-8 encoded bytes. Whitespace
+    # is every UTF-8 sequence which decodes to a character matched by \s,
+    # so break points found on byte boundaries are exactly those found
+    # after decoding, and continuation bytes take up no columns. Decoding
+    # a line and measuring it as text is quicker than counting characters
+    # in bytes, so layout() only uses these rules on lines which are not
+    # valid UTF-8, and lays out lines of plain ASCII a byte at a time.
+
+    spaces = [unichr(code).encode('utf-8') for code in
+              (0x85, 0xa0, 0x1680, 0x180e, 0x2000, 0x2001, 0x2002, 0x2003,
+               0x2004, 0x2005, 0x2006, 0x2007, 0x2008, 0x2009, 0x200a,
+               0x2028, 0x2029, 0x202f, 0x205f, 0x3000)
+              if unichr(code).isspace()]
+    s = b'(?:[\t-\r\x1c-\x1f ]|' + b'|'.join(map(re.escape, spaces)) + b')'
+    S = b'(?:[^\t-\r\x1c-\x1f \x80-\xbf\xc2\xe1-\xe3]' \
+        b'[^\t-\r\x1c-\x1f \xc2\xe1-\xe3]*' \
+        b'|(?!' + s + b')[^\x80-\xbf][\x80-\xbf]*)'
+    after = b'(?:(?<=[\t-\r\x1c-\x1f ])|' \
+        + b'|'.join(b'(?<=' + re.escape(space) + b')' for space in spaces) \
+        + b')'
+    continuation = bytes(bytearray(range(0x80, 0xc0)))
+
+    space, empty, linefeed = b' ', b'', b'\n'
+    lead = re.compile(b'(>+ ?|)( ?)(' + s + b'*)', re.DOTALL)
+    words = re.compile(S + b'+', re.DOTALL)
+    leading = re.compile(S + b'+' + s + b'*', re.DOTALL)
+    ascii = re.compile(b'[^\t-\r\x1c-\x1f ]+')
+    stripped = re.compile(b'.*[^ ]', re.DOTALL)
+    signature = re.compile(b'-- \\Z')
+    escape = re.compile(b'From ')
+    stuffed = re.compile(b'From |>')
+    nested = re.compile(b'>')
+    controls = re.compile(b'[\t\n\r]')
+    high = re.compile(b'[\x80-\xff]')
+    inside = re.compile(b'[\x80-\xbf]')
+    beyond = re.compile(b'[\xcc-\xff]')
+    reach = b'(?:[^\x80-\xbf][\x80-\xbf]*){0,%d}(?:\\Z|' + after \
+        + b'(?!' + s + b'))'
+    flags = re.DOTALL
+    del s, S, after
+
+    def count(self, text, start, end):
+        if self.high.search(text, start, end) is None:
+            return end - start
+        return len(bytes(text[start:end]).translate(None, self.continuation))
+
+    def index(self, text, start, end):
+        if self.high.search(text, start, end) is None:
+            words = self.ascii.finditer(text, start, end)
+        else:
+            words = self.words.finditer(text, start, end)
+        spans = [word.span() for word in words]
+        return (array('I', [span[0] for span in spans]),
+                array('I', [span[1] for span in spans]))
+
+    def marks(self, text, start, end):
+        # Offsets of the continuation bytes in text[start:end], or None if
+        # every character in the range is a single byte.
+
+        if self.high.search(text, start, end) is None:
+            return None
+        return [mark.start() for mark in self.inside.finditer(text, start, end)]
+
+    def fit(self, ends, lo, start, room, marks):
+        # Continuation bytes take up no columns, so keep widening the search
+        # by the number of them passed over until it stops growing.
+
+        if marks is None:
+            return Text.fit(self, ends, lo, start, room, marks)
+        before, hidden = bisect.bisect_left(marks, start), 0
+        while True:
+            lo = bisect.bisect_left(ends, start + room + hidden, lo)
+            if lo >= len(ends):
+                return lo
+            passed = bisect.bisect_left(marks, ends[lo]) - before
+            if passed == hidden:
+                return lo
+            hidden = passed
+
+    def widths(self, starts, ends, marks):
+        if marks is None:
+            return Text.widths(self, starts, ends, marks)
+        return array('I', [end - start - bisect.bisect_left(marks, end)
+                           + bisect.bisect_left(marks, start)
+                           for start, end in zip(starts, ends)])
+
+    def codes(self, text, start, end):
+        return (code for code in bytearray(text[start:end])
+                if not 0x80 <= code < 0xc0)
+
+class ASCII(UTF8):
+    # UTF-8 lines with no bytes above 0x7f, in which every byte is a whole
+    # character one column wide and only ASCII whitespace separates words.
+
+    lead = re.compile(b'(>+ ?|)( ?)([\t-\r\x1c-\x1f ]*)')
+    words = UTF8.ascii
+    leading = re.compile(b'[^\t-\r\x1c-\x1f ]+[\t-\r\x1c-\x1f ]*')
+    reach = b'.{0,%d}(?:\\Z|(?<=[\t-\r\x1c-\x1f ])(?=[^\t-\r\x1c-\x1f ]))'
+
+    def count(self, text, start, end):
+        return end - start
+
+    def uniform(self, text, start, end):
+        return True
+
+    def index(self, text, start, end):
+        return Text.index(self, text, start, end)
+
+    def marks(self, text, start, end):
+        return None
+
+characters, utf8, octets = Text(), UTF8(), ASCII()
+
+class Paragraph(object):
+    # A line of text parsed once, so that it can be broken at any number
+    # of widths. The quote prefix, space stuffing and indentation are
+    # worked out up front; word offsets and widths are only indexed, into
+    # compact unsigned arrays, the first time a layout needs them. Given a
+    # cache, layout() and wrap() keep paragraphs there by content alone,
+    # so they may be shared between threads and each lazy part is only
+    # published once complete.
+
+    def __init__(self, text, pos = 0, end = None, dialect = characters):
+        end = len(text) if end is None else end
+        self.text, self.pos, self.dialect = text, pos, dialect
+
+        match = dialect.lead.match(text, pos, end)
+        self.quote, self.prefix = match.group(1), match.end(1)
+        self.head = dialect.empty
+        if dialect.signature.match(text, self.prefix, end):
+            self.end, self.fixed = end, True
+        else:
+            stripped = dialect.stripped.match(text, pos, end)
+            self.end = stripped.end() if stripped else pos
+            if not self.quote:
+                if match.end(2) > match.start(2) \
+                        or dialect.escape.match(text, pos, self.end):
+                    self.head = dialect.space
+            self.fixed = match.end(3) > match.start(2)
+
+        self.length = self.words = self.tokens = None
+        self.marks, self.widths, self.reach = False, None, None
+        self.spaced = None
+
+    def size(self):
+        # The width of the line if it is not broken, measured only when
+        # flowing, as fill() and balance() need the widths of the words.
+
+        if self.length is None:
+            self.length = len(self.head) \
+                + self.dialect.count(self.text, self.pos, self.end)
+        return self.length
+
+    def index(self):
+        if self.words is None:
+            self.words = self.dialect.index(self.text, self.pos, self.end)
+        return self.words
+
+    def measure(self):
+        if self.marks is False:
+            self.marks = self.dialect.marks(self.text, self.pos, self.end)
+        return self.marks
+
+    def breaks(self):
+        # The offsets flow() may break at: the end of each word and the
+        # whitespace following it, skipping any words within the quote.
+
+        if self.tokens is None:
+            starts, ends = self.index()
+            skip = bisect.bisect_right(ends, self.prefix)
+            tokens = starts[skip + 1:]
+            if skip < len(starts):
+                tokens.append(self.end)
+            self.tokens = tokens
+        return self.tokens
+
+    def spans(self, width):
+        # Lay out the line as a list of (head, start, stop) spans, each an
+        # output line head + text[start:stop]. Breaks are only made after
+        # the first word on a line, as soon as the expanded line would
+        # reach width, so one long word is never split. Continuation lines
+        # are space-stuffed if they would otherwise read as a quote.
+
+        dialect, text, quote = self.dialect, self.text, self.quote
+        head, start, end = self.head, self.pos, self.end
+        if self.fixed or self.size() <= width:
+            return [(head, start, end)]
+
+        # Without tabs, line breaks or characters from U+0300 on, every
+        # character is one column, so each break is found by one bounded
+        # match from the start of the output line and the words are never
+        # indexed. Otherwise the breaks are found among the word offsets,
+        # by bisecting them when there are no tabs or line breaks.
+
+        plain = dialect.controls.search(text, start, end) is None
+        if plain and dialect.uniform(text, start, end):
+            fit, ends = dialect.fitter(text, start, end), None
+            first = dialect.leading.search(text, self.prefix, end)
+            if not first:
+                return [(head, start, end)]
+        else:
+            ends = self.breaks()
+            if not ends:
+                return [(head, start, end)]
+            marks = self.measure() if plain else None
+
+        spans, index = [], 0
+        while True:
+            if ends is None:
+                if first.end() == end:
+                    break
+                cursor = fit(start, max(width - len(head) - 1, 0))
+                if cursor == end:
+                    break
+                cursor = max(cursor, first.end())
+            elif plain:
+                scan = dialect.fit(ends, index + 1, start, width - len(head),
+                                   marks)
+            else:
+                length, column = dialect.advance(text, start, ends[index],
+                                                 len(head), len(head))
+                scan = index + 1
+                while scan < len(ends):
+                    length, column = dialect.advance(text, ends[scan - 1],
+                                                     ends[scan], length,
+                                                     column)
+                    if length >= width:
+                        break
+                    scan += 1
+            if ends is not None:
+                if scan >= len(ends):
+                    break
+                cursor, index = ends[scan - 1], scan
+
+            spans.append((head, start, cursor))
+            if not quote:
+                if dialect.stuffed.match(text, cursor, end):
+                    head = dialect.space
+                else:
+                    head = dialect.empty
+            elif quote[-1:] != dialect.space \
+                    and dialect.nested.match(text, cursor, end):
+                head = quote + dialect.space
+            else:
+                head = quote
+            start = cursor
+            if ends is None:
+                first = dialect.leading.match(text, start, end)
+
+        spans.append((head, start, end))
+        return spans
+
+    def running(self):
+        # Running totals of the word widths, each plus a separating space,
+        # so the width of words i to j-1 set on a line is reach[j] -
+        # reach[i] - 1. They are signed, as items of an unsigned array are
+        # long integers on Python 2 and balance() would do its sums in them.
+
+        if self.reach is None:
+            starts, ends = self.index()
+            self.widths = self.dialect.widths(starts, ends, self.measure())
+            reach = array('l', [0])
+            for size in self.widths:
+                reach.append(reach[-1] + size + 1)
+            self.reach = reach
+        return self.reach
+
+    def render(self, breaks, initial, subsequent):
+        text, space = self.text, self.dialect.space
+        starts, ends = self.index()
+        lines, indent = [], initial
+        for start, stop in zip(breaks, breaks[1:]):
+            lines.append(indent + space.join(text[starts[word]:ends[word]]
+                                             for word in range(start, stop)))
+            indent = subsequent
+        return self.dialect.linefeed.join(lines)
+
+    def fill(self, width, initial = u'', subsequent = u''):
+        # Greedily fill the words of the paragraph into lines of at most
+        # width columns, separated by single spaces, in the same way as
+        # textwrap.fill() without breaking long words or on hyphens. The
+        # words are joined with single spaces once, and each line is found
+        # by bounded matches on the joined text, as in spans().
+
+        dialect, words = self.dialect, self.joined()
+        uniform = dialect.uniform(words, 0, len(words))
+        lines, start, indent = [], 0, initial
+        while start < len(words):
+            stop = self.line(words, start, max(width - len(indent), 0),
+                             uniform)
+            lines.append(indent + words[start:stop])
+            start, indent = stop + 1, subsequent
+        return dialect.linefeed.join(lines)
+
+    def joined(self):
+        if self.spaced is None:
+            self.spaced = self.dialect.space.join(
+                self.text[self.pos:self.end].split())
+        return self.spaced
+
+    def line(self, words, start, room, uniform):
+        # Return the end of the longest run of words from start taking at
+        # most room columns, or of the first word if even that is wider.
+        # The run is first bounded by room characters, which is exact when
+        # every character is one column. Otherwise the bound is scaled down
+        # while the run is too wide, then raised a word at a time while the
+        # next word still fits.
+
+        dialect, size = self.dialect, room
+        while True:
+            match = dialect.compile(dialect.filled, size).match(words, start)
+            if match is None or match.end() == start:
+                match = dialect.word.match(words, start)
+            stop = match.end()
+            if uniform:
+                return stop
+            taken = dialect.count(words, start, stop)
+            if taken > room and words.find(dialect.space, start, stop) >= 0:
+                size = min(stop - start - 1, (stop - start) * room // taken)
+                continue
+            if stop == len(words):
+                return stop
+            following = dialect.word.match(words, stop + 1).end()
+            if dialect.count(words, start, following) > room:
+                return stop
+            size = following - start
+
+    def balance(self, width, initial = u'', subsequent = u''):
+        # Fill the words into lines of at most width columns, choosing the
+        # breaks which minimise the sum of the squared space left at the
+        # end of every line but the last. Only the breaks within width
+        # columns before each word are tried, found by bisecting the
+        # running totals, so there are at most width / 2 of them and the
+        # cost is linear in the length of the paragraph. Long words sit
+        # alone on a line as they do with fill().
+
+        reach = self.running()
+        count = len(reach) - 1
+        first, rest = width - len(initial), width - len(subsequent)
+        costs, breaks = [0] * (count + 1), [0] * (count + 1)
+        for stop in range(1, count + 1):
+            end = reach[stop] - 1
+            low = bisect.bisect_left(reach, end - max(first, rest), 0, stop)
+            best = None
+            for start in range(stop - 1, min(low, stop - 1) - 1, -1):
+                room = rest if start else first
+                size = end - reach[start]
+                if size > room and start < stop - 1:
+                    break
+                cost = costs[start]
+                if stop < count and size < room:
+                    cost += (room - size) ** 2
+                if best is None or cost < best:
+                    best, breaks[stop] = cost, start
+            costs[stop] = best
+
+        chosen = [count]
+        while chosen[-1] > 0:
+            chosen.append(breaks[chosen[-1]])
+        return self.render(chosen[::-1], initial, subsequent)
+
+def decoded(text, pos, end, width, cache = None):
+    # Lay out a UTF-8 line as text, then map the character offsets of the
+    # spans back to byte offsets, or return None if it is not valid UTF-8.
+
+    try:
+        line = bytes(text[pos:end]).decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    spans, offset, last = [], pos, 0
+    for head, start, stop in layout(line, 0, len(line), width,
+                                    characters, cache):
+        offset += len(line[last:start].encode('utf-8'))
+        first = offset
+        offset += len(line[start:stop].encode('utf-8'))
+        spans.append((head.encode('utf-8'), first, offset))
+        last = stop
+    return spans
+
+def layout(text, pos, end, width, dialect = characters, cache = None):
+    # Given a cache, the spans of any line which needs breaking are kept
+    # relative to the start of the line, keyed by a hash of its content,
+    # the width and whether offsets are in bytes or characters. The parsed
+    # paragraph is kept under the same key without the width, so laying
+    # the line out again at another width reuses its index of words.
+
+    if dialect is utf8 and utf8.high.search(text, pos, end) is None:
+        dialect = octets
+    elif dialect is utf8:
+        spans = decoded(text, pos, end, width, cache)
+        if spans is not None:
+            return spans
+
+    paragraph = Paragraph(text, pos, end, dialect)
+    if cache is None or paragraph.fixed or paragraph.size() <= width:
+        return paragraph.spans(width)
+
+    content = text[pos:end]
+    if dialect is characters:
+        content = content.encode('utf-8')
+    digest = hashlib.sha1(content).digest()
+    key = (digest, width, dialect is not characters)
+    spans = cache.get(key)
+    if spans is None:
+        line = text[pos:end] if dialect is characters else bytes(content)
+        spans = parsed(line, digest, dialect, cache).spans(width)
+        cache.put(key, spans, 160 + 120 * len(spans))
+    return [(head, start + pos, stop + pos) for head, start, stop in spans]
+
+def parsed(line, digest, dialect, cache):
+    # The cached Paragraph of a whole line, parsed and stored if missing.
+    # Its size is estimated from the line and the word index it may hold.
+
+    key = (digest, dialect is not characters)
+    paragraph = cache.get(key)
+    if paragraph is None:
+        paragraph = Paragraph(line, 0, len(line), dialect)
+        cache.put(key, paragraph, 200 + 4 * len(line))
+    return paragraph
+
+def soft(spans, text, space):
+    # Without padspace a soft break is the space a line already ends with,
+    # so a break after any other whitespace would be read back as a hard
+    # one. Such a line is joined to the next, as a long word would be.
+
+    joined = spans[:1]
+    for head, start, stop in spans[1:]:
+        last, lead, cursor = joined[-1]
+        if text[cursor - 1:cursor] == space:
+            joined.append((head, start, stop))
+        else:
+            joined[-1] = (last, lead, stop)
+    return joined
+
+def flow(text, width, padspace=True, cache=None):
+    spans = layout(text, 0, len(text), width, characters, cache)
+    if not padspace:
+        spans = soft(spans, text, characters.space)
+    pad = u' ' if padspace else u''
+    lines = [head + text[start:end] + pad for head, start, end in spans]
+    lines[-1] = lines[-1][:len(lines[-1]) - len(pad)]
+    return lines
+
+def wrap(text, level, width, detect_bullet_list, optimal = False,
+         cache = None):
+    initial = subsequent = len(text) - len(text.lstrip())
+    if detect_bullet_list and initial > 0:
+        if text.lstrip().startswith(('- ', '+ ', '* ')):
+            subsequent += 2
+    if cache is None:
+        paragraph = Paragraph(text)
+    else:
+        digest = hashlib.sha1(text.encode('utf-8')).digest()
+        paragraph = parsed(text, digest, characters, cache)
+    fill = paragraph.balance if optimal else paragraph.fill
+    return fill(width - level - 1 if level > 0 else width,
+                ' ' * initial, ' ' * subsequent)
+
+candidates = {}
+
+def flow_bytes(data, width, padspace=True, cache=None):
+    # Flow every line of a UTF-8 or ASCII buffer without decoding it. Only
+    # lines which are too long, need stuffing or have trailing spaces are
+    # looked at in Python; everything else is found by a single regex scan.
+    # The output is joined once from the lines in between and the flowed
+    # ones.
+
+    if width not in candidates:
+        candidates[width] = re.compile(b'^(?: |From |[^\n]{%d}|[^\n]* $)'
+                                       b'[^\n]*' % (width + 1), re.MULTILINE)
+    text = view(data)
+    pieces, pos = [], 0
+    for candidate in candidates[width].finditer(text):
+        start, end = candidate.span()
+        pieces.append(text[pos:start])
+        pieces.append(flowed(text, start, end, width, padspace, cache))
+        pos = end
+    pieces.append(text[pos:])
+    return bytearray().join(pieces)
+
+def flowed(text, pos, end, width, padspace, cache):
+    # The flowed lines of text[pos:end] as UTF-8. A line with high bytes is
+    # decoded and laid out as text, which is quicker than counting its
+    # characters in bytes, unless it is not valid UTF-8.
+
+    line, dialect = text, octets
+    if utf8.high.search(text, pos, end):
+        try:
+            line = bytes(text[pos:end]).decode('utf-8')
+            pos, end, dialect = 0, len(line), characters
+        except UnicodeDecodeError:
+            dialect = utf8
+    spans = layout(line, pos, end, width, dialect, cache)
+    if not padspace:
+        spans = soft(spans, line, dialect.space)
+    pad = dialect.space if padspace else dialect.empty
+    lines = [head + line[start:stop] + pad for head, start, stop in spans]
+    lines[-1] = lines[-1][:len(lines[-1]) - len(pad)]
+    lines = dialect.linefeed.join(lines)
+    return lines.encode('utf-8') if dialect is characters else lines
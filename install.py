@@ -43,7 +43,13 @@ setup(
                 'Supported%sPluginCompatibilityUUIDs' % version:
                     compatibility_uuids
             },
-            'semi_standalone': True
+            'semi_standalone': True,
+
+            # MailFlow.py imports these on first use through load(), which
+            # py2app cannot follow, so they are bundled explicitly.
+
+            'includes': ['columns', 'compose', 'flowed', 'flowtext',
+                         'mimescan', 'preflow', 'render']
         }
     },
     setup_requires = ['py2app']
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+
+from array import array
+import errno
+import getopt
+import io
+import mmap
+import os
+import re
+import struct
+import sys
+import zlib
+
+# Messages in an mboxrd file begin with a From_ line, and any line within a
+# message matching />+From / has had one '>' added. The mbox is mapped into
+# memory and messages are returned as slices of the mapping, so nothing is
+# read or copied until it is used.
+
+separator = re.compile(br'\nFrom ')
+quoted = re.compile(br'\n>(>*From )')
+
+try:
+    buffer
+except NameError:
+    def piece(data, start, stop):
+        return memoryview(data)[start:stop]
+else:
+    def piece(data, start, stop):
+        return buffer(data, start, stop - start)
+
+# The index is stored in MBOX.idx as a header followed by the offset of each
+# From_ line as a little-endian 64-bit integer. The header records how much
+# of the mbox was indexed and a checksum of its last few kilobytes, which is
+# enough to notice when the mbox has been replaced or truncated rather than
+# appended to.
+
+magic, header, tail = b'mboxrd-index-1\n\0', struct.Struct('<16sQIQ'), 4096
+
+try:
+    typecode = array('Q').typecode
+except ValueError:
+    typecode = 'L'
+
+def checksum(data, size):
+    return zlib.crc32(piece(data, max(0, size - tail), size)) & 0xffffffff
+
+class Mailbox(object):
+    def __init__(self, path, persist = True):
+        self.path, self.offsets = path, array(typecode)
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size:
+            self.data = mmap.mmap(self.file.fileno(), self.size,
+                                  access = mmap.ACCESS_READ)
+        else:
+            self.data = b''
+        indexed = self.load()
+        if indexed < self.size:
+            self.scan(indexed)
+            if persist:
+                self.save()
+
+    def load(self):
+        # Read a stored index which covers a prefix of the mbox, returning
+        # the number of bytes it covers, or 0 if there is no usable index.
+
+        try:
+            with open(self.path + '.idx', 'rb') as source:
+                fields = header.unpack(source.read(header.size))
+                label, size, crc, count = fields
+                if label != magic or size > self.size:
+                    return 0
+                if crc != checksum(self.data, size):
+                    return 0
+                self.offsets.fromfile(source, count)
+        except (IOError, OSError, EOFError, struct.error):
+            del self.offsets[:]
+            return 0
+        if sys.byteorder != 'little':
+            self.offsets.byteswap()
+        return size
+
+    def scan(self, start):
+        # A From_ line only partly present at the end of the indexed prefix
+        # was not indexed, and its preceding line feed is at most five bytes
+        # before the end. Searching for the line feed as well as 'From ' is
+        # many times faster than matching at the start of every line.
+
+        if start == 0 and self.data[:5] == b'From ':
+            self.offsets.append(0)
+        for match in separator.finditer(self.data, max(0, start - 5)):
+            self.offsets.append(match.start() + 1)
+
+    def save(self):
+        offsets = array(typecode, self.offsets)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        temporary = '%s.idx.%d' % (self.path, os.getpid())
+        try:
+            with open(temporary, 'wb') as target:
+                target.write(header.pack(magic, self.size,
+                                         checksum(self.data, self.size),
+                                         len(offsets)))
+                offsets.tofile(target)
+            os.rename(temporary, self.path + '.idx')
+        except (IOError, OSError):
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def span(self, number):
+        # Return the start and end of a message, excluding the blank line
+        # separating it from the next.
+
+        start = self.offsets[number]
+        if number + 1 < len(self.offsets):
+            end = self.offsets[number + 1]
+        else:
+            end = self.size
+        if end - start >= 2 and self.data[end - 2:end] == b'\n\n':
+            end -= 1
+        return start, end
+
+    def __getitem__(self, number):
+        # Return a message as it appears in the mbox, still quoted.
+        start, end = self.span(number)
+        return piece(self.data, start, end)
+
+    def unquoted(self, number):
+        # Yield the pieces of a message with mboxrd quoting removed.
+        start, end = self.span(number)
+        for match in quoted.finditer(self.data, start, end):
+            yield piece(self.data, start, match.start() + 1)
+            start = match.start(1)
+        yield piece(self.data, start, end)
+
+    def message(self, number):
+        return b''.join(map(bytes, self.unquoted(number)))
+
+    def close(self):
+        if self.size:
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+        return False
+
+def numbers(ranges, count):
+    # Parse message numbers and ranges such as 3 or 5-9, counting from one.
+    for item in ranges:
+        first, _, last = item.partition('-')
+        first, last = int(first), int(last or first)
+        if not 1 <= first <= last <= count:
+            raise IndexError(item)
+        for number in range(first - 1, last):
+            yield number
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "lu",
+                                   ["list", "unquote"])
+        assert len(args) >= 1
+    except:
+        sys.stderr.write('''\
+Usage: %s [-l | -u] MBOX [N | N-M]...
+Options:
+  -l, --list      list the number, offset, size and From_ line of messages
+  -u, --unquote   remove mboxrd From quoting from the messages written
+''' % sys.argv[0])
+        sys.exit(64)
+
+    listing, unquote = False, False
+    for opt, arg in opts:
+        if opt in ("-l", "--list"):
+            listing = True
+        elif opt in ("-u", "--unquote"):
+            unquote = True
+
+    with Mailbox(args[0]) as mailbox:
+        try:
+            chosen = list(numbers(args[1:], len(mailbox)))
+        except (IndexError, ValueError) as error:
+            sys.stderr.write('Invalid message number: %s\n' % error)
+            sys.exit(1)
+        if len(args) == 1:
+            chosen = range(len(mailbox))
+
+        output = io.open(sys.stdout.fileno(), 'wb', 1 << 20, closefd = False)
+        try:
+            for number in chosen:
+                start, end = mailbox.span(number)
+                if listing:
+                    stop = mailbox.data.find(b'\n', start, end)
+                    output.write(b'%d\t%d\t%d\t' % (number + 1, start,
+                                                    end - start))
+                    output.write(mailbox.data[start:stop if stop >= 0
+                                                    else end] + b'\n')
+                else:
+                    # No view into the mapping may outlive this loop, or
+                    # closing the mailbox fails on Python 3.
+                    if unquote:
+                        output.write(mailbox.message(number))
+                    else:
+                        output.write(mailbox[number])
+                    output.write(b'\n')
+            output.close()
+        except IOError as error:
+            if error.errno != errno.EPIPE:
+                raise
+
+if __name__ == '__main__':
+    main()
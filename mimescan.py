@@ -0,0 +1,183 @@
+from collections import namedtuple
+from flowtext import runs, view
+import binascii
+import bisect
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Line lengths follow bytes.splitlines(), so they exclude the CR, LF or
+# CRLF terminator. SMTP limits lines to 998 octets excluding CRLF.
+
+Stats = namedtuple('Stats', 'size lines longest eightbit')
+
+high = re.compile(b'[\x80-\xff]')
+
+def scan(data, chunksize = 1 << 16):
+    # Measure the longest line and look for 8-bit bytes in a single pass
+    # over data, which may be any object supporting the buffer protocol.
+    # NumPy works on the buffer in place when it is available; otherwise
+    # the data is split a chunk at a time so memory use stays bounded.
+
+    if numpy is not None:
+        return vectorised(data)
+
+    text = view(data)
+    size, lines, longest, carry = len(text), 0, 0, 0
+    for offset in range(0, size, chunksize):
+        chunk = bytes(text[offset:offset + chunksize])
+        lines += chunk.count(b'\n')
+
+        # The first part of each chunk continues the line carried over
+        # from the last one, and the final part carries on into the next
+        # unless the chunk ends with a line terminator.
+
+        lengths = list(map(len, chunk.splitlines())) or [0]
+        lengths[0] += carry
+        if chunk[-1:] in (b'\n', b'\r'):
+            carry = 0
+        else:
+            carry = lengths.pop()
+        if lengths:
+            longest = max(longest, max(lengths))
+    if size and text[size - 1:size] not in (b'\n', b'\r'):
+        lines += 1
+    longest = max(longest, carry)
+    return Stats(size, lines, longest, high.search(text) is not None)
+
+def vectorised(data):
+    array = numpy.frombuffer(data, dtype = numpy.uint8)
+    if not array.size:
+        return Stats(0, 0, 0, False)
+    breaks = numpy.flatnonzero((array == 10) | (array == 13))
+    edges = numpy.concatenate(([-1], breaks, [array.size]))
+    longest = int((numpy.diff(edges) - 1).max())
+    lines = int(numpy.count_nonzero(array == 10))
+    if array[-1] != 10 and array[-1] != 13:
+        lines += 1
+    return Stats(array.size, lines, longest, bool((array > 127).any()))
+
+def encoding(stats):
+    # Choose a transfer encoding for a text/plain part: 7bit or 8bit if
+    # every line is within the SMTP limit of 998 octets, otherwise None to
+    # leave the choice to Mail.
+
+    if stats.longest > 998:
+        return None
+    return '8bit' if stats.eightbit else '7bit'
+
+# Exact encoded sizes for parts which cannot be sent as 7bit or 8bit. The
+# quoted-printable size is the length binascii.b2a_qp() would produce, and
+# the base64 size that of 76-column lines. The base64 size follows from the
+# length alone, so cheapest() only has to build the quoted-printable
+# output, which b2a_qp() does faster than any walk could measure it, and
+# builds base64 only when it comes out smaller.
+
+Choice = namedtuple('Choice', 'transfer size saved encoded')
+
+# Bytes b2a_qp escapes as =XX, including a full stop alone on a line, which
+# some servers would otherwise take as the end of the message.
+
+escaped = re.compile(b'[\x00-\x08\x0b\x0c\x0e-\x1f=\x7f-\xff]+'
+                     b'|^\\.(?=[\n\r\x00]|\\Z)', re.M)
+trailing = re.compile(b'[ \t]\r?\n')
+wide = re.compile(b'[^\n]{26,}')
+
+def crlf(text):
+    # Like b2a_qp, take the line endings of the first line as those used.
+    match = re.search(b'\n', text)
+    if match is None:
+        return False
+    return text[match.start() - 1:match.start()] == b'\r'
+
+def soft(bounds, start, end, limit):
+    # Count the soft line breaks b2a_qp would insert in text[start:end],
+    # taking each escaped run and each gap between them in one step. A
+    # stretch of bytes costing weight each fills what is left of the
+    # current output line, then as many whole lines as it needs.
+
+    breaks, length, offset = 0, 0, start
+    index = bisect.bisect_right(bounds, start) & ~1
+    while offset < end:
+        if index < len(bounds) and bounds[index] <= offset:
+            stop, weight = min(bounds[index + 1], end), 3
+            index += 2
+        else:
+            stop, weight = end, 1
+            if index < len(bounds):
+                stop = min(bounds[index], end)
+        count, room = stop - offset, (limit - 1 - length) // weight
+        if count <= room:
+            length += count * weight
+        else:
+            count, capacity = count - room, (limit - 1) // weight
+            breaks += (count - 1) // capacity + 1
+            length = ((count - 1) % capacity + 1) * weight
+        offset = stop
+    return breaks
+
+def qp_size(data, limit = 76):
+    # Follow the first pass of b2a_qp() with istext set, where each byte
+    # costs one or three, each line ending one or two, and a soft line
+    # break comes before any byte which would take an output line to
+    # limit. Only lines long enough to need breaking are walked.
+
+    text = view(data)
+    size = len(text)
+    if not size:
+        return 0
+    bounds, before = runs(escaped.finditer(text))
+    if text[size - 1:size] in (b' ', b'\t'):
+        bounds.extend([size - 1, size])
+        before.append(before[-1] + 1)
+    ending = crlf(text)
+
+    breaks = 0
+    for match in wide.finditer(text):
+        start, end = match.span()
+
+        # The last byte of a line ending in LF or of the data is never
+        # preceded by a soft break if it is sent as it is, so it is left
+        # out of the walk. With CRLF it is treated like any other.
+
+        if end < size and text[end - 1:end] == b'\r':
+            end -= 1
+        elif not bisect.bisect_right(bounds, end - 1) & 1:
+            end -= 1
+        breaks += soft(bounds, start, end, limit)
+
+    newlines = len(re.findall(b'\n', text))
+    pairs = len(re.findall(b'\r\n', text))
+    size += 2 * (before[-1] + len(trailing.findall(text)))
+    size += newlines - pairs if ending else -pairs
+    return size + breaks * (3 if ending else 2)
+
+def base64_size(size, ending = False):
+    # Every three bytes become four characters, in lines of 76 columns.
+    return (size + 2) // 3 * 4 + (size + 56) // 57 * (2 if ending else 1)
+
+def cheapest(data, stats):
+    # Choose quoted-printable or base64 for a part with lines too long for
+    # 7bit or 8bit, whichever is smaller, along with the bytes saved over
+    # the quoted-printable Mail would otherwise use and the encoded part.
+
+    quoted = binascii.b2a_qp(view(data))
+    size = base64_size(stats.size, crlf(view(data)))
+    if size < len(quoted):
+        return Choice('base64', size, len(quoted) - size,
+                      encode(data, 'base64'))
+    return Choice('quoted-printable', len(quoted), 0, quoted)
+
+def encode(data, transfer):
+    # Encode data as quoted-printable or base64, to exactly the size
+    # qp_size() or base64_size() gives.
+
+    data = bytes(view(data))
+    if transfer == 'quoted-printable':
+        return binascii.b2a_qp(data)
+    encoded = b''.join(binascii.b2a_base64(data[offset:offset + 57])
+                       for offset in range(0, len(data), 57))
+    return encoded.replace(b'\n', b'\r\n') if crlf(data) else encoded
@@ -1,45 +1,277 @@
 #!/usr/bin/python
 
-from AppKit import NSPasteboard
+from email.header import decode_header
+from email.utils import mktime_tz, parsedate_tz
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 import errno
 import getopt
+import io
+import os
 import re
+import socket
 import sys
+import time
+
+# A line is quoted if it matches />*From / anywhere after the first line,
+# which is the From_ separator supplied with the message by Mail. Messages
+# are searched one window at a time, and a line which may carry on past the
+# end of a window matches the second alternative so it can be searched
+# again from the start of the next.
+
+quoted = re.compile(br'\n>*(?:(From )|(?:F(?:r(?:om?)?)?)?\Z)')
+newline = re.compile(br'\n')
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], "n", ["no-quote-from"])
-    assert len(args) == 0
-except:
-    sys.stderr.write('''\
-Usage: %s [-n]
+    buffer
+except NameError:
+    def piece(data, start, stop):
+        return memoryview(data)[start:stop]
+else:
+    def piece(data, start, stop):
+        return buffer(data, start, stop - start)
+
+def readable(message):
+    # Return message data in a form both re and piece() accept, copying it
+    # only when the pasteboard object does not support the buffer protocol.
+
+    try:
+        quoted.search(message, 0, 0)
+        piece(message, 0, 0)
+        return message
+    except TypeError:
+        return bytearray(message)
+
+def sink(path = None, size = 1 << 20):
+    if path is None or path == '-':
+        return io.open(sys.stdout.fileno(), 'wb', size, closefd = False)
+    return io.open(path, 'wb', size)
+
+def write(output, data, quote_from = True, chunksize = 1 << 20):
+    # Write a message to output followed by a blank line, with mboxrd From
+    # quoting unless quote_from is false. Unquoted runs are written straight
+    # from the message data without copying.
+
+    size, done, pos, span = len(data), 0, 0, chunksize
+    while quote_from and pos < size:
+        end, resume = min(pos + span, size), None
+        for match in quoted.finditer(data, pos, end):
+            if match.group(1) is not None:
+                output.write(piece(data, done, match.start() + 1))
+                output.write(b'>')
+                done = match.start() + 1
+            elif end < size:
+                resume = match.start()
+        if resume == pos:
+            span *= 2
+        else:
+            pos, span = end if resume is None else resume, chunksize
+    output.write(piece(data, done, size))
+    if size and bytes(piece(data, size - 1, size)) == b'\n':
+        output.write(b'\n')
+    else:
+        output.write(b'\n\n')
+
+# Sorting, filtering and removing duplicates only needs the header block of
+# each message, which ends at the first blank line. Header fields are
+# unfolded but only decoded or parsed when asked for.
+
+blank = re.compile(br'\r?\n\r?\n')
+fields = re.compile(r'^(subject|date|message-id):[ \t]*(.*(?:\r?\n[ \t].*)*)',
+                    re.I | re.M)
+numbering = re.compile(r'\[[^\]]*?(\d+)/\d+\s*\]')
+
+class Summary(object):
+    def __init__(self, data):
+        match = blank.search(data)
+        end = match.start() if match else len(data)
+        block = bytes(piece(data, 0, end)).decode('utf-8', 'replace')
+        self.data, self.fields = data, {}
+        for match in fields.finditer(block):
+            value = re.sub(r'\r?\n[ \t]+', ' ', match.group(2)).strip()
+            self.fields.setdefault(match.group(1).lower(), value)
+
+    @property
+    def subject(self):
+        parts = []
+        try:
+            for part, charset in decode_header(self.fields.get('subject', '')):
+                if isinstance(part, bytes):
+                    part = part.decode(charset or 'utf-8', 'replace')
+                parts.append(part)
+        except (LookupError, ValueError):
+            return self.fields.get('subject', u'')
+        return u''.join(parts)
+
+    @property
+    def date(self):
+        parsed = parsedate_tz(self.fields.get('date', ''))
+        return mktime_tz(parsed) if parsed else None
+
+    @property
+    def number(self):
+        match = numbering.search(self.subject)
+        return int(match.group(1)) if match else 0
+
+    @property
+    def identifier(self):
+        return self.fields.get('message-id') or None
+
+def select(messages, order = None, unique = False, pattern = None):
+    # Return messages whose subjects match pattern, without any repeated
+    # Message-ID, ordered by their [PATCH n/m] numbering or by date. Other
+    # messages keep their original order, ahead of any numbered patches or
+    # after any dated messages respectively.
+
+    summaries, seen = [], set()
+    for data in messages:
+        summary = Summary(data)
+        if pattern is not None and not pattern.search(summary.subject):
+            continue
+        if unique and summary.identifier is not None:
+            if summary.identifier in seen:
+                continue
+            seen.add(summary.identifier)
+        summaries.append(summary)
+
+    if order == 'patch':
+        summaries.sort(key = lambda summary: summary.number)
+    elif order == 'date':
+        summaries.sort(key = lambda summary: (summary.date is None,
+                                              summary.date))
+    return [summary.data for summary in summaries]
+
+def envelope(data):
+    # Return the offset of the message proper, following any From_ line.
+    if bytes(piece(data, 0, 5)) != b'From ':
+        return 0
+    match = newline.search(data)
+    return match.end() if match else len(data)
+
+def store(job):
+    path, name, data = job
+    fd = os.open(os.path.join(path, 'tmp', name),
+                 os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with io.open(fd, 'wb') as target:
+        target.write(piece(data, envelope(data), len(data)))
+
+def sync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def flush(path, names):
+    # Make a batch of messages written to tmp/ durable together, with a
+    # single sync() where the platform has one, or else by syncing each in
+    # one pass once the whole batch has been written.
+
+    if hasattr(os, 'sync'):
+        os.sync()
+        return
+    for name in names:
+        sync(os.path.join(path, 'tmp', name))
+
+def maildir(path, messages, batch = 64, threads = 8):
+    # Deliver messages without their From_ lines into the Maildir at path,
+    # taking them from any iterable one batch at a time. A pool of threads
+    # writes each batch into tmp/, which is flushed to disk at once before
+    # the messages are renamed into new/, so a crash never leaves a partial
+    # message in new/. The renames are made durable by syncing new/ once per
+    # batch rather than per message.
+
+    for name in ('tmp', 'new', 'cur'):
+        try:
+            os.makedirs(os.path.join(path, name), 0o700)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+    now, host = time.time(), socket.gethostname()
+    host = host.replace('/', r'\057').replace(':', r'\072')
+    unique = '%d.M%dP%dQ%%d.%s' % (now, now % 1 * 1e6, os.getpid(), host)
+
+    pool, messages, start = ThreadPool(threads), iter(messages), 0
+    try:
+        while True:
+            jobs = [(path, unique % (start + index + 1), data) for index, data
+                    in enumerate(islice(messages, batch))]
+            if not jobs:
+                break
+            start += len(jobs)
+            pool.map(store, jobs)
+            flush(path, [name for path, name, data in jobs])
+            for path, name, data in jobs:
+                os.rename(os.path.join(path, 'tmp', name),
+                          os.path.join(path, 'new', name))
+            sync(os.path.join(path, 'new'))
+    finally:
+        pool.close()
+        pool.join()
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "f:m:no:s:u",
+                                   ["filter=", "maildir=", "no-quote-from",
+                                    "output=", "sort=", "unique"])
+        assert len(args) == 0
+        quote_from, output, directory = True, None, None
+        order, unique, pattern = None, False, None
+        for opt, arg in opts:
+            if opt in ("-f", "--filter"):
+                pattern = re.compile(arg)
+            elif opt in ("-m", "--maildir"):
+                directory = arg
+            elif opt in ("-n", "--no-quote-from"):
+                quote_from = False
+            elif opt in ("-o", "--output"):
+                output = arg
+            elif opt in ("-s", "--sort"):
+                assert arg in ("patch", "date")
+                order = arg
+            elif opt in ("-u", "--unique"):
+                unique = True
+        assert output is None or directory is None
+    except:
+        sys.stderr.write('''\
+Usage: %s [-n] [-f REGEX] [-s patch|date] [-u] [-o FILE | -m DIR]
 Options:
+  -f, --filter=REGEX    only include messages with subjects matching REGEX
+  -m, --maildir=DIR     deliver into Maildir DIR instead of writing an mbox
   -n, --no-quote-from   disable mbox From_ quoting
+  -o, --output=FILE     write to FILE instead of stdout
+  -s, --sort=patch      sort messages by their [PATCH n/m] numbering
+  -s, --sort=date       sort messages by their Date headers
+  -u, --unique          drop messages repeating an earlier Message-ID
 ''' % sys.argv[0])
-    sys.exit(64)
+        sys.exit(64)
+
+    from AppKit import NSPasteboard
+    pasteboard = NSPasteboard.generalPasteboard()
+    if not pasteboard:
+        sys.exit(1)
 
-quote_from = True
-for opt, arg in opts:
-    if opt in ("-n", "--no-quote-from"):
-        quote_from = False
+    items = pasteboard.propertyListForType_('RFC822MessageDatasPboardType')
+    if not items:
+        sys.exit(1)
 
-pasteboard = NSPasteboard.generalPasteboard()
-if not pasteboard:
-    sys.exit(1)
+    messages = [readable(item['message']) for item in items]
+    if order or unique or pattern is not None:
+        messages = select(messages, order, unique, pattern)
 
-items = pasteboard.propertyListForType_('RFC822MessageDatasPboardType')
-if not items:
-    sys.exit(1)
+    if directory is not None:
+        maildir(directory, messages)
+        return
 
-for item in items:
-    data = bytearray(item['message'])
-    if quote_from:
-        data = re.sub(r'\n(>*From )', r'\n>\1', data)
+    target = sink(output)
     try:
-        sys.stdout.write(data)
-        if data[-1] == ord('\n'):
-            sys.stdout.write('\n')
-        else:
-            sys.stdout.write('\n\n')
+        for data in messages:
+            write(target, data, quote_from)
+        target.close()
     except IOError as error:
         if error.errno != errno.EPIPE:
             raise
+
+if __name__ == '__main__':
+    main()
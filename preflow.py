@@ -0,0 +1,51 @@
+from flowtext import layout, utf8
+from multiprocessing.pool import ThreadPool
+import tracing
+
+# Flow the paragraphs of a message being composed in the background, once
+# the user pauses, so their line breaks are already in the flow cache when
+# the message is sent. Mail emits each paragraph as one long line, and the
+# send hook looks up each line by its UTF-8 content, so paragraphs are
+# encoded and laid out here exactly as flow_bytes() will lay them out.
+# Anything edited since, or never reached, simply misses the cache and is
+# flowed inline as before.
+
+class Preflow(object):
+    def __init__(self, cache, threads = 1):
+        # Only one thread can flow at a time under the GIL, so a single
+        # worker is enough to keep the main thread free.
+
+        self.cache, self.pool = cache, ThreadPool(threads)
+        self.generation, self.known = 0, set()
+
+    def submit(self, lines, width, whole = True):
+        # Queue the lines too long to send unbroken which have not already
+        # been flowed. Given the whole body, any job still running from an
+        # earlier call gives up at its next line, as the text it was given
+        # is out of date. The lines of a single block are queued behind it
+        # instead, so the rest of the body is still flowed.
+
+        if whole:
+            self.generation += 1
+        lines = [line.encode('utf-8') for line in lines]
+        lines = [line for line in lines if len(line) > width]
+        self.known &= set((line, width) for line in lines)
+        changed = [line for line in lines if (line, width) not in self.known]
+        if changed:
+            tracing.count('preflow lines', len(changed))
+            self.pool.apply_async(self.flow, (self.generation, changed,
+                                              width))
+
+    def flow(self, generation, lines, width):
+        known = self.known
+        for line in lines:
+            if generation != self.generation:
+                return
+            with tracing.span('preflow'):
+                layout(line, 0, len(line), width, utf8, self.cache)
+            known.add((line, width))
+
+    def close(self):
+        self.generation += 1
+        self.pool.close()
+        self.pool.join()
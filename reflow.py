@@ -0,0 +1,239 @@
+#!/usr/bin/python
+
+from collections import deque
+from flowtext import flow, flow_bytes
+from io import BytesIO
+from mboxrd import Mailbox
+from mimescan import cheapest, encoding, scan
+import errno
+import getopt
+import multiprocessing
+import os
+import pbmbox
+import sys
+import time
+import tracing
+
+try:
+    from email import message_from_bytes as parse
+    from email.generator import BytesGenerator as Generator
+except ImportError:
+    from email import message_from_string as parse
+    from email.generator import Generator
+
+# Flow the text/plain parts of archived messages as MailFlow does when Mail
+# sends them: every line is flowed, delsp=yes and format=flowed are added,
+# and the transfer encoding is chosen the same way, 7bit or 8bit where the
+# lines allow and otherwise the smaller of quoted-printable and base64.
+# Messages with no such parts are passed through byte for byte.
+
+def reflow(body, charset, width):
+    # Flow a decoded body as the send hook does, or return None if its
+    # charset is not understood.
+
+    body = body.replace(b'\r\n', b'\n')
+    if charset.lower() in ('utf-8', 'utf8', 'us-ascii', 'ascii'):
+        return bytes(flow_bytes(body, width))
+    try:
+        lines = body.decode(charset).split(u'\n')
+        lines = [line for text in lines for line in flow(text, width)]
+        return u'\n'.join(lines).encode(charset)
+    except (LookupError, UnicodeError):
+        return None
+
+def rewrite(part, width):
+    # Flow a part in place, returning whether it was changed. Parts which
+    # are attachments or already flowed are left alone.
+
+    if part.get_content_type() != 'text/plain' or part.is_multipart():
+        return False
+    if str(part.get_param('format', '')).lower() == 'flowed':
+        return False
+    if part.get('content-disposition', '').lower().startswith('attachment'):
+        return False
+    body = part.get_payload(decode = True)
+    if not body:
+        return False
+    body = reflow(body, part.get_content_charset('us-ascii'), width)
+    if body is None:
+        return False
+
+    stats = scan(body)
+    transfer = encoding(stats)
+    if transfer is None:
+        transfer, size, saved, body = cheapest(body, stats)
+    if bytes is not str:
+        body = body.decode('ascii', 'surrogateescape')
+    if 'content-transfer-encoding' in part:
+        part.replace_header('content-transfer-encoding', transfer)
+    else:
+        part['Content-Transfer-Encoding'] = transfer
+    part.set_payload(body)
+    part.set_param('delsp', 'yes', requote = False)
+    part.set_param('format', 'flowed', requote = False)
+    return True
+
+def convert(data, width):
+    # Return the message with its parts flowed, the number of parts changed
+    # or None if the message could not be handled, and its original size.
+
+    start = pbmbox.envelope(data)
+    try:
+        message = parse(data[start:])
+        changed = sum(rewrite(part, width) for part in message.walk())
+    except Exception:
+        return data, None, len(data)
+    if not changed:
+        return data, 0, len(data)
+    output = BytesIO()
+    Generator(output, mangle_from_ = False, maxheaderlen = 0).flatten(message)
+    return data[:start] + output.getvalue(), changed, len(data)
+
+def work(job):
+    width, messages = job
+    return [convert(data, width) for data in messages]
+
+def mbox(path):
+    with Mailbox(path) as source:
+        for number in range(len(source)):
+            yield source.message(number)
+
+def maildir(path):
+    # Yield the messages in a Maildir in order of their names, which begin
+    # with the time of delivery, adding a From_ line to each.
+
+    names = [os.path.join(path, folder, name) for folder in ('cur', 'new')
+             for name in os.listdir(os.path.join(path, folder))
+             if not name.startswith('.')]
+    for name in sorted(names, key = os.path.basename):
+        with open(name, 'rb') as source:
+            data = source.read()
+        stamp = time.asctime(time.gmtime(os.path.getmtime(name)))
+        yield b'From MAILER-DAEMON ' + stamp.encode('ascii') + b'\n' + data
+
+def chunks(messages, size, limit = 1 << 24):
+    # Group messages into chunks of at most size messages or about limit
+    # bytes, so each dispatch to a worker carries enough work to outweigh
+    # the cost of pickling it across.
+
+    chunk, total = [], 0
+    for data in messages:
+        chunk.append(data)
+        total += len(data)
+        if len(chunk) >= size or total >= limit:
+            yield chunk
+            chunk, total = [], 0
+    if chunk:
+        yield chunk
+
+def process(messages, width, jobs, size):
+    # Yield the converted messages in their original order. Chunks are
+    # handed to a pool of worker processes, with no more than two per
+    # worker in flight so memory stays bounded however large the source.
+
+    pool, pending = multiprocessing.Pool(jobs), deque()
+    try:
+        for chunk in chunks(messages, size):
+            pending.append(pool.apply_async(work, ((width, chunk),)))
+            while len(pending) >= 2 * jobs:
+                for result in pending.popleft().get():
+                    yield result
+        while pending:
+            for result in pending.popleft().get():
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+class Report(object):
+    # Count messages and bytes as they are written, reporting throughput
+    # to stderr at the end and every interval seconds if given.
+
+    def __init__(self, interval = None):
+        self.messages, self.size, self.parts, self.failed = 0, 0, 0, 0
+        self.interval, self.start = interval, tracing.clock()
+        self.last = self.start
+
+    def count(self, results):
+        for data, changed, size in results:
+            self.messages, self.size = self.messages + 1, self.size + size
+            if changed is None:
+                self.failed += 1
+            else:
+                self.parts += changed
+            if self.interval and tracing.clock() - self.last >= self.interval:
+                self.write()
+            yield data
+
+    def write(self):
+        self.last = tracing.clock()
+        elapsed = max(self.last - self.start, 1e-6)
+        sys.stderr.write('%d messages, %.1f MB in %.1fs: %.0f messages/s, '
+                         '%.2f MB/s, %d parts flowed, %d failed\n'
+                         % (self.messages, self.size / 1e6, elapsed,
+                            self.messages / elapsed,
+                            self.size / 1e6 / elapsed, self.parts,
+                            self.failed))
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "c:j:m:o:qvw:",
+                                   ["chunk=", "jobs=", "maildir=", "output=",
+                                    "quiet", "verbose", "width="])
+        assert len(args) == 1
+        jobs, size, width = multiprocessing.cpu_count(), 256, 76
+        output, directory, interval, quiet = None, None, None, False
+        for opt, arg in opts:
+            if opt in ("-c", "--chunk"):
+                size = int(arg)
+            elif opt in ("-j", "--jobs"):
+                jobs = int(arg)
+            elif opt in ("-m", "--maildir"):
+                directory = arg
+            elif opt in ("-o", "--output"):
+                output = arg
+            elif opt in ("-q", "--quiet"):
+                quiet = True
+            elif opt in ("-v", "--verbose"):
+                interval = 1.0
+            elif opt in ("-w", "--width"):
+                width = int(arg)
+        assert jobs > 0 and size > 0 and width > 0
+        assert output is None or directory is None
+    except:
+        sys.stderr.write('''\
+Usage: %s [OPTIONS] MBOX | MAILDIR
+Options:
+  -c, --chunk=N         send workers N messages at a time (default 256)
+  -j, --jobs=N          run N worker processes (default one per CPU)
+  -m, --maildir=DIR     deliver into Maildir DIR instead of writing an mbox
+  -o, --output=FILE     write an mbox to FILE instead of stdout
+  -q, --quiet           do not report throughput when finished
+  -v, --verbose         report throughput every second as well
+  -w, --width=N         flow lines to N columns (default 76)
+''' % sys.argv[0])
+        sys.exit(64)
+
+    if os.path.isdir(args[0]):
+        source = maildir(args[0])
+    else:
+        source = mbox(args[0])
+    report = Report(interval)
+    messages = report.count(process(source, width + 1, jobs, size))
+
+    if directory is not None:
+        pbmbox.maildir(directory, messages)
+    else:
+        target = pbmbox.sink(output)
+        try:
+            for data in messages:
+                pbmbox.write(target, data)
+            target.close()
+        except IOError as error:
+            if error.errno != errno.EPIPE:
+                raise
+    if not quiet:
+        report.write()
+
+if __name__ == '__main__':
+    main()
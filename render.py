@@ -0,0 +1,79 @@
+from flowed import paragraphs
+import re
+
+# Render a decoded text/plain part as HTML for the message viewer. Quoted
+# lines become nested blockquotes with their quote markers removed, and
+# each line break becomes <BR>. Unquoted stretches, which make up the bulk
+# of long logs and attachments, are escaped whole with string methods
+# rather than a line at a time.
+
+quoted = re.compile(u'^>.*(?:\n>.*)*\n?', re.M)
+marker = re.compile(u'(>+) ?')
+spaces = re.compile(u'(^ +)| {2,}', re.M)
+
+def nbsp(match):
+    # Every leading space must be a non-breaking space to survive, but
+    # within a line one ordinary space is kept so the line can still wrap.
+    if match.group(1):
+        return u'&nbsp;' * len(match.group(1))
+    return u'&nbsp;' * (len(match.group()) - 1) + u' '
+
+def escape(text):
+    text = text.replace(u'&', u'&amp;').replace(u'<', u'&lt;')
+    text = spaces.sub(nbsp, text.replace(u'>', u'&gt;'))
+    return text.replace(u'\n', u'<BR>')
+
+def runs(text):
+    # Yield (depth, text) for each run of lines at the same quote depth,
+    # with the quote markers and one following space removed.
+
+    pos = 0
+    for match in quoted.finditer(text):
+        if match.start() > pos:
+            yield 0, text[pos:match.start()]
+        depth, lines = None, []
+        for line in match.group().splitlines(True):
+            prefix = marker.match(line)
+            level = len(prefix.group(1))
+            if lines and level != depth:
+                yield depth, u''.join(lines)
+                lines = []
+            depth = level
+            lines.append(line[prefix.end():])
+        yield depth, u''.join(lines)
+        pos = match.end()
+    if pos < len(text):
+        yield 0, text[pos:]
+
+def reflowed(text, delsp = False):
+    # Yield (depth, text) as runs() does, but with the soft line breaks of
+    # a format=flowed body removed so the viewer can fill each paragraph to
+    # the width of the window.
+
+    depth, lines = None, []
+    for paragraph in paragraphs(text.splitlines(True), delsp):
+        if lines and paragraph.depth != depth:
+            yield depth, u''.join(lines)
+            lines = []
+        depth = paragraph.depth
+        lines.append(paragraph.text + u'\n')
+    if lines:
+        if not text.endswith(u'\n'):
+            lines[-1] = lines[-1][:-1]
+        yield depth, u''.join(lines)
+
+def pieces(text, flowed = False, delsp = False):
+    level = 0
+    for depth, chunk in reflowed(text, delsp) if flowed else runs(text):
+        if depth > level:
+            yield u'<BLOCKQUOTE type="cite">' * (depth - level)
+        elif depth < level:
+            yield u'</BLOCKQUOTE>' * (level - depth)
+        level = depth
+        yield escape(chunk)
+    yield u'</BLOCKQUOTE>' * level
+
+def render(text, flowed = False, delsp = False):
+    if u'\r' in text:
+        text = text.replace(u'\r\n', u'\n')
+    return u''.join(pieces(text, flowed, delsp))
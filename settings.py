@@ -0,0 +1,80 @@
+from collections import namedtuple
+
+# Every MailFlow preference as (attribute, defaults key, type, default).
+# A backend is anything with bool, int and object mappings from key to
+# value, such as NSUserDefaults with the MailFlow category or the Memory
+# class below.
+
+preferences = [
+    ('is_flow_text', 'FlowText', 'bool', False),
+    ('is_wrap_text', 'WrapText', 'bool', False),
+    ('is_wrap_once', 'WrapOnce', 'bool', False),
+    ('is_fix_attribution', 'FixAttribution', 'bool', False),
+    ('detect_bullet_list', 'BulletLists', 'bool', True),
+    ('indent_width', 'IndentWidth', 'int', 2),
+    ('wrap_width', 'WrapWidth', 'int', 76),
+    ('is_optimal_wrap', 'OptimalWrap', 'bool', False),
+    ('is_snapshot_wrap', 'SnapshotWrap', 'bool', True),
+    ('is_tracing', 'Trace', 'bool', False),
+    ('is_render_text', 'RenderText', 'bool', False),
+    ('flow_cache', 'FlowCache', 'int', 4096),
+    ('preflow_delay', 'PreflowDelay', 'int', 750),
+    ('disabled_hooks', 'DisabledHooks', 'object', []),
+]
+
+class Settings(namedtuple('Settings', [item[0] for item in preferences])):
+    __slots__ = ()
+
+    @property
+    def should_wrap(self):
+        return self.is_flow_text or self.is_wrap_text
+
+class Preferences(object):
+    # An immutable Settings snapshot is read from the backend on first use
+    # and kept until invalidate() is called, normally when the defaults
+    # change. Callers should take one snapshot per operation, rather than
+    # reading attributes repeatedly.
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.current = None
+
+    def register(self):
+        self.backend.registerDefaults_(dict((key, default) for
+                                            name, key, kind, default
+                                            in preferences))
+
+    def snapshot(self):
+        current = self.current
+        if current is None:
+            current = self.current = Settings(*[
+                getattr(self.backend, kind)[key]
+                for name, key, kind, default in preferences])
+        return current
+
+    def update(self, name, value):
+        for item, key, kind, default in preferences:
+            if item == name:
+                getattr(self.backend, kind)[key] = value
+                self.invalidate()
+                return
+        raise KeyError(name)
+
+    def invalidate(self, *args):
+        self.current = None
+
+class Memory(object):
+    # A dictionary standing in for NSUserDefaults away from Mail.
+
+    def __init__(self, **values):
+        self.values, self.registered = dict(values), {}
+        self.bool = self.int = self.object = self
+
+    def registerDefaults_(self, values):
+        self.registered.update(values)
+
+    def __getitem__(self, key):
+        return self.values.get(key, self.registered.get(key))
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
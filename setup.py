@@ -123,7 +123,8 @@ setup(
     data_files=DATA_FILES,
     options = dict(py2app = dict(
         dist_dir            = install_path,
-        includes        = ['appdirs', 'packaging', 'packaging.version', 'packaging.specifiers', 'packaging.requirements'],
+        includes        = ['appdirs', 'packaging', 'packaging.version', 'packaging.specifiers', 'packaging.requirements',
+                           'columns', 'compose', 'flowed', 'flowtext', 'mimescan', 'preflow', 'render'],
         semi_standalone     = False,
         extension           = '.mailbundle',
         plist               = PLIST,
@@ -0,0 +1,105 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import Cache
+from compose import enclosing, plain, snapshot
+from flowtext import flow_bytes
+from preflow import Preflow
+
+class Node(object):
+    # Just enough of a WebKit DOM node for compose.Snapshot to walk.
+
+    def __init__(self, name, children = (), data = None):
+        self.name, self.text, self.parent = name, data, None
+        self.children, self.sibling = [], None
+        for child in children:
+            if not isinstance(child, Node):
+                child = Node('#text', data = child)
+            child.parent = self
+            if self.children:
+                self.children[-1].sibling = child
+            self.children.append(child)
+
+    def nodeType(self):
+        return 3 if self.name == '#text' else 1
+
+    def nodeName(self):
+        return self.name
+
+    def data(self):
+        return self.text
+
+    def firstChild(self):
+        return self.children[0] if self.children else None
+
+    def nextSibling(self):
+        return self.sibling
+
+    def parentNode(self):
+        return self.parent
+
+width = 77
+first = u'A first paragraph typed straight into the body, ' * 3
+second = u'Then one with\xa0 runs of\xa0 spaces and accents, caf\xe9. ' * 4
+quoted = u'A paragraph quoted from the message being replied to. ' * 3
+nested = u'And one quoted within that quote, in a span. ' * 4
+
+# A plain text compose body, and the text Mail puts in the plain text part
+# for it on sending, which is what the send hook flows.
+
+def body(nested = nested):
+    inner = Node('SPAN', [nested])
+    root = Node('BODY', [
+        first,
+        Node('DIV', [second]),
+        Node('DIV', [Node('BR')]),
+        Node('BLOCKQUOTE', [
+            Node('DIV', [quoted]),
+            Node('BLOCKQUOTE', [Node('DIV', [inner])])]),
+        Node('DIV', [u'Short\nlines', Node('BR'), u'end'])])
+    return root, inner.firstChild()
+
+def sent(nested = nested):
+    return u'\n'.join([first, second, u'', u'> ' + quoted, u'>> ' + nested,
+                       u'Short', u'lines', u'end']).encode('utf-8')
+
+class SnapshotTest(unittest.TestCase):
+    def test_plain(self):
+        root, caret = body()
+        self.assertEqual(u'\n'.join(plain(snapshot(root))).encode('utf-8'),
+                         sent())
+
+    def test_enclosing(self):
+        root, caret = body()
+        block, level = enclosing(root, caret)
+        self.assertEqual((block.nodeName(), level), ('DIV', 2))
+        self.assertEqual(plain(snapshot(block, level)), [u'>> ' + nested])
+        self.assertEqual(enclosing(root, root.firstChild()), None)
+
+    def test_preflow(self):
+        # Lines flowed from snapshots are all found in the cache when the
+        # sent text is flowed, both for the whole body and for the block
+        # edited after it, and the output is the same as without.
+
+        cache = Cache()
+        preflow = Preflow(cache)
+        root, caret = body()
+        preflow.submit(plain(snapshot(root)), width)
+        edited = nested.replace(u'span', u'longer span')
+        root, caret = body(edited)
+        preflow.submit(plain(snapshot(*enclosing(root, caret))), width,
+                       False)
+        preflow.pool.close()
+        preflow.pool.join()
+
+        for data in sent(), sent(edited):
+            misses = cache.misses
+            flowed = flow_bytes(bytearray(data), width, cache = cache)
+            self.assertEqual(cache.misses, misses)
+            self.assertEqual(flowed, flow_bytes(bytearray(data), width))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import io
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flowed import paragraphs, reflow
+from flowtext import flow
+
+corpus = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'flow_corpus.json')
+widths = (10, 20, 40, 76, 77, 78)
+
+# Lines flowed with padspace carry an extra space at each soft break, to be
+# deleted on decoding as with delsp=yes. Without it, each soft break is the
+# space that followed the last word, which decoding keeps, as delsp=no.
+
+class RoundTrip(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with io.open(corpus, encoding = 'utf-8') as source:
+            cls.lines = json.load(source)
+        cls.lines += [u'', u' ', u'   ', u' \t', u'\t', u'>', u'> ', u'>  ',
+                      u'-- ', u'From here', u' indented', u'a  ' * 30]
+
+    def test_reflow(self):
+        for padspace in (True, False):
+            for width in widths:
+                for line in self.lines:
+                    flowed = flow(line, width, padspace)
+                    self.assertEqual(list(reflow(flowed, width, padspace,
+                                                 padspace)),
+                                     flowed, (line, width, padspace))
+
+    def test_body(self):
+        for padspace in (True, False):
+            for width in widths:
+                body = [flowed for line in self.lines
+                        for flowed in flow(line, width, padspace)]
+                self.assertEqual(list(reflow(body, width, padspace,
+                                             padspace)),
+                                 body, (width, padspace))
+
+    def test_whitespace(self):
+        self.assertEqual(flow(u' ', 76), [u' '])
+        self.assertEqual(list(reflow([u' '], 76)), [u' '])
+        self.assertEqual([paragraph.text for paragraph
+                          in paragraphs([u' ', u'next'])], [u' ', u'next'])
+
+if __name__ == '__main__':
+    unittest.main()
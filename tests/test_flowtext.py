@@ -0,0 +1,179 @@
+import io
+import json
+import os
+import re
+import sys
+import textwrap
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import Cache
+from flowtext import Paragraph, flow, flow_bytes, layout, wrap
+
+# Lines generated to cover quoting, tabs and other whitespace, space
+# stuffing, 'From ' escaping, the '-- ' signature line, trailing spaces,
+# accented text and words longer than a line. Nothing in them is U+0300 or
+# above, and no continuation line begins with '>', as the widths of those
+# characters and the stuffing of those lines were changed deliberately.
+
+corpus = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'flow_corpus.json')
+widths = (10, 20, 40, 76, 77, 78)
+
+def original(text, width, padspace=True):
+    # flow() as it was before flowtext.py, kept as the reference. Only the
+    # joining of breaks after other whitespace without padspace is new.
+
+    quote, indent = re.match(r'(>+ ?|)(\s*)', text, re.UNICODE).groups()
+    prefix = len(quote)
+    if text[prefix:] == u'-- ':
+        return [text]
+    text = text.rstrip(u' ')
+
+    if not quote:
+        if indent.startswith(u' ') or text.startswith(u'From '):
+            text = u' ' + text
+    if indent or len(text) <= width:
+        return [text]
+
+    matches = re.finditer(r'\S+\s*(?=\S|$)', text[prefix:], re.UNICODE)
+    breaks, lines = [match.end() + prefix for match in matches], []
+    head = 0
+    while True:
+        for index, cursor in enumerate(breaks[1:]):
+            if len(text[:cursor].expandtabs()) >= width:
+                cursor = breaks[index]
+                break
+        else:
+            lines.append((head, text))
+            return joined(lines, padspace)
+        lines.append((head, text[:cursor]))
+        if not quote and text[cursor:].startswith(u'From '):
+            text, cursor, head = u' ' + text[cursor:], cursor - 1, 1
+        else:
+            text, cursor, head = quote + text[cursor:], cursor - prefix, prefix
+        breaks = [offset - cursor for offset in breaks[index + 1:]]
+
+def joined(lines, padspace):
+    # Pad each soft break with a space, or without padspace join any line
+    # not already ending in one to the next, less the next line's head.
+
+    if padspace:
+        return [line + u' ' for head, line in lines[:-1]] + [lines[-1][1]]
+    result = [lines[0][1]]
+    for head, line in lines[1:]:
+        if result[-1].endswith(u' '):
+            result.append(line)
+        else:
+            result[-1] += line[head:]
+    return result
+
+def filled(text, width, detect_bullet_list):
+    # wrap() as it was before flowtext.py, filling with textwrap.
+    initial = subsequent = len(text) - len(text.lstrip())
+    if detect_bullet_list and initial > 0:
+        if text.lstrip().startswith(('- ', '+ ', '* ')):
+            subsequent += 2
+    return textwrap.fill(u' '.join(text.split()), width,
+                         break_long_words = False, break_on_hyphens = False,
+                         initial_indent = u' ' * initial,
+                         subsequent_indent = u' ' * subsequent)
+
+def balanced(text, width, detect_bullet_list):
+    # wrap() with optimal breaks, trying each earlier break in turn until a
+    # line would be too wide rather than bisecting for the first to try.
+    initial = subsequent = len(text) - len(text.lstrip())
+    if detect_bullet_list and initial > 0:
+        if text.lstrip().startswith(('- ', '+ ', '* ')):
+            subsequent += 2
+    words = text.split()
+    count = len(words)
+    costs, breaks = [0] * (count + 1), [0] * (count + 1)
+    for stop in range(1, count + 1):
+        best = None
+        for start in range(stop - 1, -1, -1):
+            room = width - (subsequent if start else initial)
+            size = len(u' '.join(words[start:stop]))
+            if size > room and start < stop - 1:
+                break
+            cost = costs[start]
+            if stop < count and size < room:
+                cost += (room - size) ** 2
+            if best is None or cost < best:
+                best, breaks[stop] = cost, start
+        costs[stop] = best
+    chosen = [count]
+    while chosen[-1] > 0:
+        chosen.append(breaks[chosen[-1]])
+    chosen.reverse()
+    return u'\n'.join((u' ' * (subsequent if start else initial))
+                      + u' '.join(words[start:stop])
+                      for start, stop in zip(chosen, chosen[1:]))
+
+class Corpus(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with io.open(corpus, encoding = 'utf-8') as source:
+            cls.lines = json.load(source)
+
+    def test_flow(self):
+        for padspace in (True, False):
+            for width in widths:
+                for line in self.lines:
+                    self.assertEqual(flow(line, width, padspace),
+                                     original(line, width, padspace),
+                                     (line, width, padspace))
+
+    def test_flow_bytes(self):
+        data = u'\n'.join(self.lines).encode('utf-8')
+        for padspace in (True, False):
+            for width in widths:
+                expected = u'\n'.join(u'\n'.join(flow(line, width, padspace))
+                                      for line in self.lines)
+                self.assertEqual(bytes(flow_bytes(data, width, padspace)),
+                                 expected.encode('utf-8'), (width, padspace))
+
+    def test_wrap(self):
+        paragraphs = [u'\n'.join(self.lines[index:index + 5]).expandtabs()
+                      for index in range(0, len(self.lines), 5)]
+        paragraphs.append(u'  - ' + u' '.join(self.lines[:20]).expandtabs())
+        for width in widths:
+            for text in paragraphs:
+                self.assertEqual(wrap(text, 0, width, True),
+                                 filled(text, width, True), (text, width))
+
+    def test_balance(self):
+        paragraphs = [u'\n'.join(self.lines[index:index + 5]).expandtabs()
+                      for index in range(0, len(self.lines), 5)]
+        paragraphs.append(u'  - ' + u' '.join(self.lines[:20]).expandtabs())
+        for width in widths:
+            for text in paragraphs:
+                self.assertEqual(wrap(text, 0, width, True, True),
+                                 balanced(text, width, True), (text, width))
+
+class Reuse(unittest.TestCase):
+    text = u'> ' + u' '.join([u'word', u'\u4e2d\u6587', u'longer-word'] * 40)
+
+    def test_layout(self):
+        cache = Cache()
+        for width in widths:
+            self.assertEqual(layout(self.text, 0, len(self.text), width,
+                                    cache = cache),
+                             Paragraph(self.text).spans(width))
+        paragraphs = [value for value, size in cache.entries.values()
+                      if isinstance(value, Paragraph)]
+        self.assertEqual(len(paragraphs), 1)
+        self.assertTrue(paragraphs[0].words is not None)
+
+    def test_wrap(self):
+        cache = Cache()
+        for optimal in (False, True):
+            for width in widths:
+                self.assertEqual(wrap(self.text, 0, width, True, optimal,
+                                      cache),
+                                 wrap(self.text, 0, width, True, optimal))
+        self.assertEqual(len(cache.entries), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import binascii
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mimescan import base64_size, cheapest, crlf, encode, qp_size, scan
+
+# Bodies around the edges of quoted-printable: lines at and beyond the SMTP
+# limit of 998 octets, whitespace before a line ending or at the very end,
+# escaped bytes straddling a soft line break, a lone full stop and CRLF.
+
+samples = [
+    b'',
+    b'plain\n',
+    b'x' * 998 + b'\n',
+    b'x' * 999 + b'\n',
+    b'x' * 998,
+    b'x' * 997 + b' \n' + b'y' * 1200,
+    b'trailing space \nand tab\t\nend ',
+    b'ends in tab\t',
+    b'\xc3\xa9' * 600 + b'\n',
+    b'a' * 73 + b'=' + b'b' * 80 + b'\n',
+    b'a' * 74 + b'\xff' * 3 + b'\n',
+    b'.\nfull stop\n.',
+    b'crlf ' * 300 + b'\r\n' + b'\xe2\x80\x94' * 400 + b' \r\n',
+    b'\r\n' * 3 + b'\t' * 200,
+]
+
+def generated(count, seed = 3676):
+    # Random bodies drawn mostly from bytes which quoted-printable treats
+    # specially, with long lines and both line endings.
+
+    state = random.Random(seed)
+    alphabet = [b'a', b' ', b'\t', b'=', b'.', b'\n', b'\r\n', b'\xc3\xa9',
+                b'\x00', b'\x7f', b'\xff', b'x' * 90]
+    for index in range(count):
+        yield b''.join(state.choice(alphabet)
+                       for step in range(state.randint(0, 400)))
+
+class SizeTest(unittest.TestCase):
+    def test_quoted_printable(self):
+        for data in samples + list(generated(500)):
+            self.assertEqual(qp_size(data), len(binascii.b2a_qp(data)),
+                             data)
+
+    def test_base64(self):
+        for data in samples:
+            self.assertEqual(base64_size(len(data), crlf(data)),
+                             len(encode(data, 'base64')), data)
+
+    def test_cheapest(self):
+        for data in samples[1:]:
+            choice = cheapest(bytearray(data), scan(data))
+            self.assertEqual(choice.encoded, encode(data, choice.transfer))
+            self.assertEqual(choice.size, len(choice.encoded))
+            other = {'base64': 'quoted-printable'}.get(choice.transfer,
+                                                       'base64')
+            self.assertTrue(choice.size <= len(encode(data, other)))
+
+if __name__ == '__main__':
+    unittest.main()
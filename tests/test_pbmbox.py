@@ -0,0 +1,54 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pbmbox
+
+def message(number):
+    return (b'From sender@example.com Thu Jan  1 00:00:00 2015\n'
+            b'Subject: [PATCH %d/200] change\n\nbody %d\n' % (number, number))
+
+class MaildirTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.calls = {'fsync': 0, 'sync': 0}
+        self.saved = dict((name, getattr(os, name, None))
+                          for name in ('fsync', 'sync'))
+
+        def fsync(fd):
+            self.calls['fsync'] += 1
+        def sync():
+            self.calls['sync'] += 1
+        os.fsync, os.sync = fsync, sync
+
+    def tearDown(self):
+        for name, function in self.saved.items():
+            if function is None:
+                if hasattr(os, name):
+                    delattr(os, name)
+            else:
+                setattr(os, name, function)
+        shutil.rmtree(self.path)
+
+    def test_batched(self):
+        pbmbox.maildir(self.path, [message(number)
+                                   for number in range(1, 151)], batch = 64)
+        self.assertEqual(self.calls, {'fsync': 3, 'sync': 3})
+        self.assertEqual(os.listdir(os.path.join(self.path, 'tmp')), [])
+        names = os.listdir(os.path.join(self.path, 'new'))
+        self.assertEqual(len(names), 150)
+        with open(os.path.join(self.path, 'new', sorted(names)[0]), 'rb') as source:
+            self.assertTrue(source.read().startswith(b'Subject: [PATCH '))
+
+    def test_without_sync(self):
+        del os.sync
+        pbmbox.maildir(self.path, [message(number)
+                                   for number in range(1, 11)], batch = 4)
+        self.assertEqual(self.calls, {'fsync': 10 + 3, 'sync': 0})
+
+if __name__ == '__main__':
+    unittest.main()
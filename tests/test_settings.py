@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from settings import Memory, Preferences, Settings, preferences
+
+class MemoryTest(unittest.TestCase):
+    def test_registered(self):
+        memory = Memory()
+        self.assertEqual(memory.int['WrapWidth'], None)
+        memory.registerDefaults_({'WrapWidth': 76})
+        self.assertEqual(memory.int['WrapWidth'], 76)
+
+    def test_values(self):
+        memory = Memory(WrapWidth = 72)
+        memory.registerDefaults_({'WrapWidth': 76, 'FlowText': False})
+        self.assertEqual(memory.int['WrapWidth'], 72)
+        memory.bool['FlowText'] = True
+        self.assertEqual(memory.bool['FlowText'], True)
+        self.assertEqual(memory.registered['FlowText'], False)
+
+    def test_kinds(self):
+        memory = Memory(DisabledHooks = ['flow'])
+        self.assertEqual(memory.object['DisabledHooks'], ['flow'])
+        memory.int['IndentWidth'] = 4
+        self.assertEqual(memory.bool['IndentWidth'], 4)
+
+class PreferencesTest(unittest.TestCase):
+    def setUp(self):
+        self.memory = Memory()
+        self.preferences = Preferences(self.memory)
+        self.preferences.register()
+
+    def test_defaults(self):
+        settings = self.preferences.snapshot()
+        self.assertTrue(isinstance(settings, Settings))
+        for name, key, kind, default in preferences:
+            self.assertEqual(getattr(settings, name), default)
+        self.assertFalse(settings.should_wrap)
+
+    def test_snapshot(self):
+        settings = self.preferences.snapshot()
+        self.memory.int['WrapWidth'] = 60
+        self.assertTrue(self.preferences.snapshot() is settings)
+        self.assertEqual(self.preferences.snapshot().wrap_width, 76)
+        self.preferences.invalidate(None)
+        self.assertEqual(self.preferences.snapshot().wrap_width, 60)
+
+    def test_update(self):
+        settings = self.preferences.snapshot()
+        self.preferences.update('is_wrap_text', True)
+        self.assertEqual(self.memory.values['WrapText'], True)
+        self.assertFalse(settings.should_wrap)
+        self.assertTrue(self.preferences.snapshot().should_wrap)
+        self.assertRaises(KeyError, self.preferences.update, 'missing', 1)
+
+if __name__ == '__main__':
+    unittest.main()
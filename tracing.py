@@ -0,0 +1,116 @@
+from collections import defaultdict
+import functools
+import os
+import time
+
+# Timed spans and counters for finding where send and Wrap Once time goes.
+# Tracing is off unless enabled with the Trace default or the
+# MAILFLOW_TRACE environment variable, and while it is off span() returns
+# a shared object which does nothing and count() returns at once. Check
+# tracing.active before doing any work just to compute a count.
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+active = os.environ.get('MAILFLOW_TRACE', '') not in ('', '0')
+counters = defaultdict(int)
+timings = {}
+
+# Latencies are kept in a histogram with power-of-two buckets, where
+# bucket k holds durations from 2**(k-1) up to 2**k microseconds.
+
+buckets = 32
+
+class Timing(object):
+    __slots__ = ('calls', 'total', 'longest', 'histogram')
+
+    def __init__(self):
+        self.calls, self.total, self.longest = 0, 0.0, 0.0
+        self.histogram = [0] * buckets
+
+    def add(self, elapsed):
+        self.calls += 1
+        self.total += elapsed
+        self.longest = max(self.longest, elapsed)
+        self.histogram[min(int(elapsed * 1e6).bit_length(), buckets - 1)] += 1
+
+class Span(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, *exception):
+        record(self.name, clock() - self.start)
+        return False
+
+class Null(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+null = Null()
+
+def enable(flag = True):
+    global active
+    active = bool(flag)
+
+def reset():
+    counters.clear()
+    timings.clear()
+
+def span(name):
+    return Span(name) if active else null
+
+def count(name, amount = 1):
+    if active:
+        counters[name] += amount
+
+def record(name, elapsed):
+    if name not in timings:
+        timings[name] = Timing()
+    timings[name].add(elapsed)
+
+def traced(name):
+    # Decorate a function to run inside a span called name, at the cost
+    # of one global lookup per call while tracing is off. The wrapper keeps
+    # the name of the function, which PyObjC uses as the selector when it
+    # adds the method to a class or category.
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not active:
+                return function(*args, **kwargs)
+            with Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def report():
+    # Return a summary of every span and counter as a list of lines, with
+    # a histogram of the non-empty latency buckets for each span.
+
+    lines = []
+    for name in sorted(timings):
+        timing = timings[name]
+        lines.append('%s: %d calls, %.3fms total, %.3fms mean, %.3fms max'
+                     % (name, timing.calls, 1000 * timing.total,
+                        1000 * timing.total / timing.calls,
+                        1000 * timing.longest))
+        lines.append('  ' + ' '.join('<%dus:%d' % (1 << bucket, calls)
+                                     for bucket, calls
+                                     in enumerate(timing.histogram) if calls))
+    for name in sorted(counters):
+        lines.append('%s: %d' % (name, counters[name]))
+    return lines